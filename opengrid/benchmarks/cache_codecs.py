@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the compression codecs of the Cache
+
+For each codec that can be imported, a realistic set of daily results is
+written to a temporary cache and read back.  The write throughput, the read
+latency for a single sensor and for all sensors, and the size on disk are
+reported.
+
+Run it with
+
+    python -m opengrid.benchmarks.cache_codecs --sensors 200 --years 4
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from opengrid.library import caching
+from opengrid.library.houseprint import Sensor
+
+
+def daily_frame(sensors, years, seed=0):
+    """
+    Return a dataframe with daily results like a cache holds them
+
+    Each sensor has a level with seasonal variation and noise, rounded to
+    0.1, and starts at a random day, so the frame has leading NaNs.
+    """
+    rng = np.random.RandomState(seed)
+    index = pd.date_range(end=pd.Timestamp.today().normalize(), periods=int(years * 365), freq='D',
+                          tz='Europe/Brussels')
+    season = np.cos(2 * np.pi * index.dayofyear.values / 365.)
+    data = {}
+    for i in range(sensors):
+        level = rng.uniform(20, 500)
+        values = level * (1 + 0.3 * season) + rng.normal(0, 0.1 * level, len(index))
+        values = np.round(values, 1)
+        values[:rng.randint(0, len(index) // 2)] = np.nan
+        data['sensor{:04d}'.format(i)] = values
+    return pd.DataFrame(data, index=index)
+
+
+def folder_size(folder):
+    return sum(os.path.getsize(os.path.join(root, filename))
+               for root, dirs, filenames in os.walk(folder) for filename in filenames)
+
+
+def run(codec, df, storage='pickle', repeat=5):
+    """
+    Return a dict with the measurements for one codec
+    """
+    folder = tempfile.mkdtemp()
+    try:
+        cache = caching.Cache('benchmark', folder=folder, storage=storage, codec=codec)
+        sensors = [Sensor(key=key) for key in df.columns]
+
+        start = time.time()
+        cache._write(df)
+        write_time = time.time() - start
+
+        single = []
+        for sensor in sensors[:repeat]:
+            start = time.time()
+            cache.get([sensor])
+            single.append(time.time() - start)
+
+        start = time.time()
+        cache.get(sensors)
+        read_all = time.time() - start
+
+        size = folder_size(folder)
+    finally:
+        shutil.rmtree(folder)
+
+    return dict(write_mb_per_s=df.memory_usage(index=True).sum() / 2.**20 / write_time,
+                read_single_ms=1000 * np.median(single),
+                read_all_ms=1000 * read_all,
+                size_mb=size / 2.**20)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sensors', type=int, default=100)
+    parser.add_argument('--years', type=float, default=3)
+    parser.add_argument('--storage', default='pickle', choices=sorted(caching.STORAGES))
+    parser.add_argument('--codecs', nargs='*', default=[None] + sorted(caching.CODECS),
+                        help="codecs to compare, default all that can be imported")
+    args = parser.parse_args(argv)
+
+    df = daily_frame(args.sensors, args.years)
+    print("{} sensors x {} days, {:.1f} MB in memory".format(
+        len(df.columns), len(df), df.memory_usage(index=True).sum() / 2.**20))
+
+    results = {}
+    for codec in args.codecs:
+        if codec == 'none':
+            codec = None
+        try:
+            results[codec or 'none'] = run(codec, df, storage=args.storage)
+        except (ImportError, ValueError) as e:
+            print("Skipping {}: {}".format(codec, e))
+
+    print(pd.DataFrame(results).T[['write_mb_per_s', 'read_single_ms', 'read_all_ms', 'size_mb']].round(2))
+
+
+if __name__ == '__main__':
+    main()
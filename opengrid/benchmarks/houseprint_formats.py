@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the file formats of the Houseprint
+
+A houseprint (a synthetic one, or the one in --file) is saved as
+jsonpickle, pickle and compact, and the file size and load time of each
+format are reported.
+
+Run it with
+
+    python -m opengrid.benchmarks.houseprint_formats --sites 2000
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from opengrid.library.houseprint import houseprint
+
+
+def synthetic_houseprint(sites, devices_per_site=2, sensors_per_device=4, seed=0):
+    """
+    Return a houseprint with sites, Fluksometers and Fluksosensors with
+    realistic attributes
+    """
+    rng = np.random.RandomState(seed)
+    hp = houseprint.Houseprint(empty_init=True)
+    types = ['electricity', 'electricity', 'gas', 'water']
+    systems = ['grid', 'solar', 'heating', 'main']
+    for i in range(sites):
+        site = houseprint.Site(key=i, size=int(rng.randint(50, 300)), inhabitants=int(rng.randint(1, 6)),
+                               postcode=int(rng.choice([1000, 2000, 3000, 9000])),
+                               construction_year=int(rng.randint(1900, 2016)), k_level='', e_level='',
+                               epc_cert=float(rng.uniform(50, 500)))
+        hp.add_site(site)
+        for j in range(devices_per_site):
+            device = houseprint.Fluksometer(key='FL{:06d}{}'.format(i, j))
+            site.add_device(device)
+            for k in range(sensors_per_device):
+                device.add_sensor(houseprint.Fluksosensor(key='{:032x}'.format(rng.randint(2**62)),
+                                                          token='{:032x}'.format(rng.randint(2**62)),
+                                                          device=device, type=types[k], system=systems[k],
+                                                          description='sensor {}'.format(k), quantity='',
+                                                          unit='', direction='Import', tariff='',
+                                                          cumulative=None))
+    return hp
+
+
+def run(hp, pickle_format, folder, repeat=3):
+    """
+    Return a dict with the file size and load time of one format
+    """
+    filename = os.path.join(folder, 'hp.' + pickle_format)
+    hp.save(filename, pickle_format=pickle_format)
+    load = []
+    for _ in range(repeat):
+        start = time.time()
+        houseprint.load_houseprint_from_file(filename, pickle_format=pickle_format)
+        load.append(time.time() - start)
+    return dict(size_kb=os.path.getsize(filename) / 1024., load_ms=1000 * np.median(load))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sites', type=int, default=1000)
+    parser.add_argument('--file', help="houseprint to use instead of a synthetic one")
+    parser.add_argument('--pickle-format', default='jsonpickle', help="format of --file")
+    args = parser.parse_args(argv)
+
+    if args.file:
+        hp = houseprint.load_houseprint_from_file(args.file, pickle_format=args.pickle_format)
+    else:
+        hp = synthetic_houseprint(args.sites)
+    print("{} sites, {} devices, {} sensors".format(len(hp.sites), len(hp.get_devices()), len(hp.get_sensors())))
+
+    folder = tempfile.mkdtemp()
+    try:
+        results = dict((pickle_format, run(hp, pickle_format, folder))
+                       for pickle_format in ['jsonpickle', 'pickle', 'compact'])
+    finally:
+        shutil.rmtree(folder)
+
+    print(pd.DataFrame(results).T[['size_kb', 'load_ms']].round(1))
+
+
+if __name__ == '__main__':
+    main()
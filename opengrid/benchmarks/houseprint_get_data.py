@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of Houseprint.get_data with a pool of threads
+
+A tmpo database with minute data for a number of synthetic Fluksosensors is
+written to a temporary folder (or the houseprint in --file is used with its
+own tmpo session), and the same get_data call is timed with an increasing
+number of workers.  The frames are checked to be identical.
+
+Run it with
+
+    python -m opengrid.benchmarks.houseprint_get_data --sensors 200 --days 7
+"""
+import argparse
+import gzip
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import tmpo
+
+from opengrid.library.houseprint import houseprint
+
+LVL = 16  # blocks of 2**16 seconds
+
+
+def _block(epochs, values):
+    """
+    Return a gzipped tmpo block with the given epochs and values
+    """
+    head = [int(epochs[0]), float(values[0])]
+    tail = [int(epochs[-1]), float(values[-1])]
+    t = np.diff(epochs, prepend=epochs[0]).astype(int).tolist()
+    v = np.round(np.diff(values, prepend=values[0]), 3).tolist()
+    blk = '{"h":%s,"t":%s,"v":%s}' % (json.dumps(dict(head=head, tail=tail), separators=(',', ':')),
+                                      json.dumps(t, separators=(',', ':')), json.dumps(v, separators=(',', ':')))
+    return gzip.compress(blk.encode('utf-8'))
+
+
+def synthetic_tmpo(folder, sensors, days, seed=0):
+    """
+    Return a tmpo session in folder with cumulative minute data for the
+    given number of sensors, and the list of sensor keys
+    """
+    rng = np.random.RandomState(seed)
+    tmpos = tmpo.Session(folder)
+    tail = int(pd.Timestamp.today().normalize().value // 10**9)
+    epochs = np.arange(tail - days * 86400, tail, 60)
+    keys = ['{:032x}'.format(rng.randint(2**62)) for _ in range(sensors)]
+
+    con = sqlite3.connect(tmpos.db)
+    con.execute(tmpo.SQL_SENSOR_TABLE)
+    con.execute(tmpo.SQL_TMPO_TABLE)
+    for key in keys:
+        con.execute(tmpo.SQL_SENSOR_INS, (key, 'token'))
+        values = np.cumsum(rng.uniform(0, 20, len(epochs)))
+        bids = epochs - epochs % 2**LVL
+        for bid in np.unique(bids):
+            mask = bids == bid
+            con.execute(tmpo.SQL_TMPO_INS, (key, 0, LVL, int(bid), 'gz', float(bid + 2**LVL),
+                                            sqlite3.Binary(_block(epochs[mask], values[mask]))))
+    con.commit()
+    con.close()
+    return tmpos, keys
+
+
+def synthetic_houseprint(tmpos, keys, sensors_per_device=4):
+    hp = houseprint.Houseprint(empty_init=True)
+    hp.init_tmpo(tmpos=tmpos)
+    for i in range(0, len(keys), sensors_per_device):
+        site = houseprint.Site(key=i)
+        hp.add_site(site)
+        device = houseprint.Fluksometer(key='FL{:08d}'.format(i))
+        site.add_device(device)
+        for key in keys[i:i + sensors_per_device]:
+            device.add_sensor(houseprint.Fluksosensor(key=key, token='token', device=device, type='electricity',
+                                                      system='', description='', quantity='', unit='',
+                                                      direction='', tariff='', cumulative=None))
+    return hp
+
+
+def run(hp, sensors, head, workers, repeat=3):
+    """
+    Return the median time of get_data and the frame
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        df = hp.get_data(sensors=sensors, head=head, workers=workers)
+        times.append(time.time() - start)
+    return np.median(times), df
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sensors', type=int, default=200)
+    parser.add_argument('--days', type=int, default=7)
+    parser.add_argument('--workers', type=int, nargs='*', default=[1, 2, 4, 8, 16])
+    parser.add_argument('--file', help="houseprint to use instead of a synthetic one, with the configured tmpo data")
+    args = parser.parse_args(argv)
+
+    folder = tempfile.mkdtemp()
+    try:
+        if args.file:
+            hp = houseprint.load_houseprint_from_file(args.file)
+            sensors = hp.get_fluksosensors()[:args.sensors]
+        else:
+            tmpos, keys = synthetic_tmpo(folder, args.sensors, args.days)
+            hp = synthetic_houseprint(tmpos, keys)
+            sensors = hp.get_sensors()
+        head = pd.Timestamp.today().normalize().tz_localize('UTC') - pd.Timedelta(days=args.days)
+
+        results = {}
+        reference = None
+        for workers in args.workers:
+            seconds, df = run(hp, sensors, head, workers)
+            if reference is None:
+                reference = df
+            else:
+                pd.testing.assert_frame_equal(reference, df)
+            results[workers] = dict(seconds=seconds)
+    finally:
+        shutil.rmtree(folder)
+
+    print("{} sensors, {} rows".format(len(sensors), len(reference)))
+    results = pd.DataFrame(results).T
+    results['speedup'] = results['seconds'].iloc[0] / results['seconds']
+    results.index.name = 'workers'
+    print(results.round(2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the resampling of raw Fluksosensor data
+
+A month of raw cumulative counter data, with a point every 5 to 60 seconds
+like tmpo holds it, is resampled with the numpy path of get_data and with
+the former pandas path (resample, reindex and interpolate).  The results are
+checked to be equal.
+
+Run it with
+
+    python -m opengrid.benchmarks.sensor_resample --days 30
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from opengrid.library.houseprint import sensor
+
+
+def raw_series(days, seed=0):
+    """
+    Return a raw cumulative series with irregular timestamps
+    """
+    rng = np.random.RandomState(seed)
+    steps = rng.randint(5, 61, int(days * 86400 / 30))
+    epochs = 1451606400 + np.cumsum(steps)
+    epochs = epochs[epochs < 1451606400 + days * 86400]
+    values = np.cumsum(rng.uniform(0, 10, len(epochs)))
+    return pd.Series(values, index=pd.to_datetime(epochs, unit='s', utc=True), name='sensor')
+
+
+def timeit(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        res = func()
+        times.append(time.time() - start)
+    return np.median(times), res
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--rules', nargs='*', default=['min', '15min', 'D'])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    data = raw_series(args.days)
+    print("{} raw points over {} days".format(len(data), args.days))
+
+    results = {}
+    for rule in args.rules:
+        for diff in [False, True]:
+            t_pandas, expected = timeit(lambda: sensor._resample_pandas(data, rule, diff=diff), args.repeat)
+            t_numpy, res = timeit(lambda: sensor._resample(data, rule, diff=diff), args.repeat)
+            pd.testing.assert_series_equal(expected, res, check_exact=False, rtol=1e-12)
+            results[(rule, diff)] = dict(pandas_ms=1000 * t_pandas, numpy_ms=1000 * t_numpy,
+                                         speedup=t_pandas / t_numpy)
+
+    results = pd.DataFrame(results).T[['pandas_ms', 'numpy_ms', 'speedup']]
+    results.index.names = ['rule', 'diff']
+    print(results.round(2))
+
+
+if __name__ == '__main__':
+    main()
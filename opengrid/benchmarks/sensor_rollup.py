@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of Fluksosensor.get_data served from the rollup store
+
+A year of raw cumulative counter data, with a point every 5 to 60 seconds
+like tmpo holds it, is served by an in-memory session.  Hourly and daily
+get_data over the whole year are timed from the raw data and from a
+caching.RollupStore, and the results are checked to be equal.  The time of
+the raw path excludes reading and decompressing the tmpo blocks, which the
+store also saves.
+
+Run it with
+
+    python -m opengrid.benchmarks.sensor_rollup --days 365
+"""
+import argparse
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from opengrid.library import caching
+from opengrid.library.houseprint import houseprint
+from opengrid.benchmarks.sensor_resample import raw_series
+
+
+class MemorySession(object):
+    """
+    Stands in for a tmpo session holding a single raw series
+    """
+    def __init__(self, raw):
+        self.raw = raw
+        self.epochs = raw.index.values.astype('datetime64[s]').astype(np.int64)
+
+    def series(self, sid, head=None, tail=None):
+        head, tail = [int(pd.Timestamp(ts).value // 10**9) if not isinstance(ts, int) else ts for ts in (head, tail)]
+        start, end = np.searchsorted(self.epochs, [head, tail + 1])
+        return self.raw.iloc[start:end]
+
+    def last_timestamp(self, sid, epoch=False):
+        return int(self.epochs[-1]) if epoch else self.raw.index[-1]
+
+
+def timeit(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        res = func()
+        times.append(time.time() - start)
+    return np.median(times), res
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--rules', nargs='*', default=['h', 'day'])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    raw = raw_series(args.days)
+    raw.name = 'sensor'
+    tmpos = MemorySession(raw)
+    device = houseprint.Fluksometer(key='device', tmpos=tmpos)
+    sensor = houseprint.Fluksosensor(key='sensor', token='token', device=device, type='electricity', system='',
+                                     description='', quantity='', unit='Wh', direction='', tariff='', cumulative=None)
+    print("{} raw points over {} days".format(len(raw), args.days))
+
+    folder = tempfile.mkdtemp()
+    try:
+        store = caching.RollupStore(folder)
+        start = time.time()
+        store.update(sensor.key, tmpos)
+        print("rollup store built in {:.0f} ms".format(1000 * (time.time() - start)))
+
+        results = {}
+        for rule in args.rules:
+            for diff in [False, True]:
+                houseprint.Sensor.rollup_store = None
+                t_raw, expected = timeit(lambda: sensor.get_data(resample=rule, diff=diff), args.repeat)
+                houseprint.Sensor.rollup_store = store
+                t_store, res = timeit(lambda: sensor.get_data(resample=rule, diff=diff), args.repeat)
+                pd.testing.assert_series_equal(expected, res)
+                results[(rule, diff)] = dict(raw_ms=1000 * t_raw, store_ms=1000 * t_store, speedup=t_raw / t_store)
+    finally:
+        houseprint.Sensor.rollup_store = None
+        shutil.rmtree(folder)
+
+    results = pd.DataFrame(results).T[['raw_ms', 'store_ms', 'speedup']]
+    results.index.names = ['rule', 'diff']
+    print(results.round(2))
+
+
+if __name__ == '__main__':
+    main()
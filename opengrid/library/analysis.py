@@ -41,7 +41,7 @@ class DailyAgg(Analysis):
     - within a time-range specified by starttime and endtime.
       This can be used eg. to get the minimum consumption during the night.
     """
-    def __init__(self, df, agg, starttime=dt.time.min, endtime=dt.time.max):
+    def __init__(self, df, agg, starttime=dt.time.min, endtime=dt.time.max, dtype=None):
         """
         Parameters
         ----------
@@ -52,13 +52,18 @@ class DailyAgg(Analysis):
         starttime, endtime : datetime.time objects
             For each day, only consider the time between starttime and endtime
             If None, use begin of day/end of day respectively
+        dtype : numpy dtype, optional
+            Type of the result, eg. 'float32'.  By default the type that
+            results from the aggregation.
         """
-        super(DailyAgg, self).__init__(df, agg, starttime=starttime, endtime=endtime)
+        super(DailyAgg, self).__init__(df, agg, starttime=starttime, endtime=endtime, dtype=dtype)
 
-    def do_analysis(self, agg, starttime=dt.time.min, endtime=dt.time.max):
+    def do_analysis(self, agg, starttime=dt.time.min, endtime=dt.time.max, dtype=None):
         if not self.df.empty:
             df = self.df[(self.df.index.time >= starttime) & (self.df.index.time < endtime)]
             df = df.resample('D', how=agg)
+            if dtype is not None:
+                df = df.astype(dtype)
             self.result = df
         else:
             self.result = pd.DataFrame()
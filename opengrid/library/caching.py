@@ -10,8 +10,21 @@ Created on Thu Jan  7 09:34:04 2016
 @author: roel
 """
 import os
+import json
+import time
+import errno
+import hashlib
+import struct
+import zlib
+import tempfile
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict, deque
 import numpy as np
 import pandas as pd
+from pandas.tseries.frequencies import to_offset
 import dateutil
 from opengrid import config
 cfg = config.Config()
@@ -19,18 +32,1448 @@ from opengrid.library import misc
 from opengrid.library import analysis
 from tqdm import tqdm
 import pickle
+try:
+    import fcntl
+except ImportError:
+    # windows: FileLock falls back to exclusively created lock files
+    fcntl = None
+
+
+def _signature(path):
+    """
+    Return (mtime, size) of a file, or None if it does not exist
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_size
+
+
+# atomic rename, also when the target exists (python 2 only has os.rename)
+_replace = getattr(os, 'replace', os.rename)
+
+
+def _atomic_write(path, write, mode='wb'):
+    """
+    Write a file with write(f) on a temporary file next to it, which is then
+    renamed to path.  Readers see either the old or the new file, never a
+    partially written one.
+    """
+    folder, name = os.path.split(path)
+    fd, tmp = tempfile.mkstemp(prefix='.' + name + '.', suffix='.tmp', dir=folder)
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        _replace(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+# Number of attempts to read cached files that are being replaced by a writer
+READ_RETRIES = 5
+
+
+def _retry(func, *args, **kwargs):
+    """
+    Call func, and call it again after a short pause if it fails on a file
+    that was replaced or removed by a writer in another process meanwhile
+    """
+    for attempt in range(READ_RETRIES):
+        try:
+            return func(*args, **kwargs)
+        except (EOFError, IOError, OSError, ValueError, pickle.UnpicklingError):
+            if attempt == READ_RETRIES - 1:
+                raise
+            time.sleep(0.05 * 2 ** attempt)
+
+
+class FileLock(object):
+    """
+    Advisory lock on a file, shared between processes
+
+    Uses fcntl.flock where available, otherwise the lock is held by creating
+    the file exclusively.  Use FileLock.get(path) to get the single FileLock
+    of a path in this process: it is reentrant, and serializes the threads of
+    this process.
+    """
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, path, timeout=600):
+        self.path = path
+        self.timeout = timeout
+        self._rlock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    @classmethod
+    def get(cls, path):
+        """
+        Return the FileLock of this path, created on first use
+        """
+        path = os.path.abspath(path)
+        with cls._instances_lock:
+            if path not in cls._instances:
+                cls._instances[path] = cls(path)
+            return cls._instances[path]
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def acquire(self):
+        self._rlock.acquire()
+        if self._depth == 0:
+            try:
+                self._lock_file()
+            except:
+                self._rlock.release()
+                raise
+        self._depth += 1
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            self._unlock_file()
+        self._rlock.release()
+
+    def _lock_file(self):
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                if fcntl is not None:
+                    fd = os.open(self.path, os.O_CREAT | os.O_RDWR)
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except:
+                        os.close(fd)
+                        raise
+                else:
+                    fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_RDWR)
+                self._fd = fd
+                return
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES, errno.EEXIST):
+                    raise
+            if time.time() > deadline:
+                raise IOError("Timeout waiting for the lock {}, remove it if no other process "
+                              "is writing".format(self.path))
+            time.sleep(0.05)
+
+    def _unlock_file(self):
+        fd, self._fd = self._fd, None
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+        else:
+            os.close(fd)
+            os.remove(self.path)
+
+
+def _truncate(df, start=None, end=None):
+    """
+    Return the rows of df between start and end (both included)
+
+    Parameters
+    ----------
+    df : pandas DataFrame with DatetimeIndex
+        A tz-naive index is considered to be in Europe/Brussels
+    start, end : tz-aware pandas Timestamp or None
+    """
+    if df.empty or (start is None and end is None):
+        return df
+    index = df.index
+    if index.tz is None:
+        index = index.tz_localize('Europe/Brussels')
+    mask = np.ones(len(index), dtype=bool)
+    if start is not None:
+        mask &= index >= start
+    if end is not None:
+        mask &= index <= end
+    return df[mask]
+
+
+def _codec_zlib():
+    import zlib
+    return zlib.compress, zlib.decompress
+
+
+def _codec_bz2():
+    import bz2
+    return bz2.compress, bz2.decompress
+
+
+def _codec_lzma():
+    import lzma
+    return lzma.compress, lzma.decompress
+
+
+def _codec_lz4():
+    try:
+        import lz4.frame
+    except ImportError:
+        raise ImportError("The lz4 codec needs lz4, install it with `pip install lz4`")
+    return lz4.frame.compress, lz4.frame.decompress
+
+
+def _codec_zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("The zstd codec needs zstandard, install it with `pip install zstandard`")
+    return zstandard.ZstdCompressor().compress, zstandard.ZstdDecompressor().decompress
+
+
+def _codec_blosc():
+    try:
+        import blosc
+    except ImportError:
+        raise ImportError("The blosc codec needs blosc, install it with `pip install blosc`")
+
+    def compress(data):
+        # byte-shuffle the float64 values, they make up most of the pickle
+        return blosc.compress(data, typesize=8, cname='lz4', shuffle=blosc.SHUFFLE)
+
+    return compress, blosc.decompress
+
+
+# name -> function returning (compress, decompress), imported on first use
+CODECS = {'zlib': _codec_zlib,
+          'bz2': _codec_bz2,
+          'lzma': _codec_lzma,
+          'lz4': _codec_lz4,
+          'zstd': _codec_zstd,
+          'blosc': _codec_blosc}
+
+
+class PickleStorage(object):
+    """
+    Storage with one pickled dataframe per sensor: folder/variable_sensor.pkl
+
+    With a codec, the pickle is compressed and prefixed with a header naming
+    the codec.  Files are read whatever codec they were written with.
+    """
+
+    MAGIC = b'opengrid-codec:'
+
+    def __init__(self, folder, variable, codec=None):
+        self.folder = folder
+        self.variable = variable
+        self.codec = codec
+        if codec is not None:
+            if codec not in CODECS:
+                raise ValueError("Codec '{}' is not supported, use one of {}".format(codec, sorted(CODECS)))
+            self._compress = CODECS[codec]()[0]
+
+    def path(self, sensorkey):
+        """
+        Return the path of the pickle for this sensor
+        """
+        filename = self.variable + '_' + sensorkey + '.pkl'
+        return os.path.join(self.folder, filename)
+
+    def load(self, sensorkey):
+        """
+        Return the dataframe for a single sensor, or an empty dataframe
+        """
+        path = self.path(sensorkey)
+        if not os.path.exists(path):
+            return pd.DataFrame()
+
+        with open(path, "rb") as f:
+            data = f.read()
+        if data.startswith(self.MAGIC):
+            codec, data = data[len(self.MAGIC):].split(b'\n', 1)
+            decompress = CODECS[codec.decode('ascii')]()[1]
+            data = decompress(data)
+        df = pickle.loads(data)
+        if isinstance(df, pd.Series):
+            df = pd.DataFrame(df)
+        return df
+
+    def read(self, sensorkeys, start=None, end=None):
+        """
+        Return a dataframe with a column for each sensor that has cached data
+
+        Parameters
+        ----------
+        sensorkeys : list of str
+        start, end : tz-aware pandas Timestamp, optional
+            Only return the days between start and end
+
+        Returns
+        -------
+        df : pandas DataFrame, empty if none of the sensors has cached data
+        """
+        dfs = [_truncate(self.load(sensorkey), start, end) for sensorkey in sensorkeys]
+        dfs = [df for df in dfs if not df.empty]
+        if dfs:
+            return pd.concat(dfs, axis=1)
+        else:
+            return pd.DataFrame()
+
+    def signatures(self, sensorkeys):
+        """
+        Return a dict with the signature of the files of each sensor, it
+        changes whenever the stored data of that sensor may have changed
+        """
+        return {sensorkey: _signature(self.path(sensorkey)) for sensorkey in sensorkeys}
+
+    def files(self, sensorkeys):
+        """
+        Return the paths of the existing files holding these sensors
+        """
+        return [self.path(sensorkey) for sensorkey in sensorkeys if os.path.exists(self.path(sensorkey))]
+
+    def sensors(self):
+        """
+        Return the keys of all sensors with a pickle for this variable
+        """
+        prefix = self.variable + '_'
+        return sorted([filename[len(prefix):-len('.pkl')] for filename in os.listdir(self.folder)
+                       if filename.startswith(prefix) and filename.endswith('.pkl')])
+
+    def write(self, df):
+        """
+        Replace the stored data of each sensor (column) in df
+        """
+        for sensor in df.columns:
+            data = pickle.dumps(df[[sensor]].dropna())
+            if self.codec is not None:
+                data = self.MAGIC + self.codec.encode('ascii') + b'\n' + self._compress(data)
+            _atomic_write(self.path(sensor), lambda f: f.write(data))
+
+
+class ColumnarStorage(object):
+    """
+    Base class for storages that keep all sensors of a variable together in
+    folder/variable/
+
+    Pickles from the PickleStorage are migrated the first time a sensor is
+    read or written, holding the lock of the variable (see Cache).
+    """
+
+    def __init__(self, folder, variable, codec=None):
+        self.folder = os.path.join(folder, variable)
+        self.variable = variable
+        self.legacy = PickleStorage(folder, variable)
+        self.lock = FileLock.get(os.path.join(folder, variable + '.lock'))
+        if not os.path.exists(self.folder):
+            os.mkdir(self.folder)
+
+    def _migrate(self, sensorkeys):
+        """
+        Move the pickles of these sensors (if any) into this storage
+        """
+        if not any(os.path.exists(self.legacy.path(sensorkey)) for sensorkey in sensorkeys):
+            return
+        with self.lock:
+            dfs = []
+            for sensorkey in sensorkeys:
+                if os.path.exists(self.legacy.path(sensorkey)):
+                    dfs.append(self.legacy.load(sensorkey))
+            dfs = [df for df in dfs if not df.empty]
+            if dfs:
+                self.write(pd.concat(dfs, axis=1))
+
+    def _remove_legacy(self, sensorkeys):
+        """
+        Remove the pickles of these sensors, they are outdated after a write
+        """
+        for sensorkey in sensorkeys:
+            if os.path.exists(self.legacy.path(sensorkey)):
+                os.remove(self.legacy.path(sensorkey))
+
+
+class ParquetStorage(ColumnarStorage):
+    """
+    Columnar storage with one parquet file per year: folder/variable/year.parquet
+
+    Each file holds a column per sensor and a shared daily index in UTC, so
+    reading many sensors is a single scan per year instead of a file per sensor.
+    """
+
+    INDEX = '_timestamp'
+
+    # codec -> parquet compression, parquet compresses each column itself
+    COMPRESSION = {None: 'snappy', 'zlib': 'gzip', 'lz4': 'lz4', 'zstd': 'zstd'}
+
+    def __init__(self, folder, variable, codec=None):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("The parquet storage needs pyarrow, install it with `pip install pyarrow`")
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        if codec not in self.COMPRESSION:
+            raise ValueError("Codec '{}' is not supported by the parquet storage, use one of {}".format(
+                codec, sorted(c for c in self.COMPRESSION if c is not None)))
+        self.compression = self.COMPRESSION[codec]
+
+        super(ParquetStorage, self).__init__(folder, variable)
+
+    def path(self, year):
+        """
+        Return the path of the partition for this year
+        """
+        return os.path.join(self.folder, '{}.parquet'.format(year))
+
+    def partitions(self):
+        """
+        Return a sorted list of (year, path) for all existing partitions
+        """
+        res = []
+        for filename in os.listdir(self.folder):
+            name, ext = os.path.splitext(filename)
+            if ext == '.parquet' and name.isdigit():
+                res.append((int(name), os.path.join(self.folder, filename)))
+        return sorted(res)
+
+    def columns(self, path):
+        """
+        Return the sensors stored in a partition, without reading the data
+        """
+        return [name for name in self._pq.read_schema(path).names if name != self.INDEX]
+
+    def signatures(self, sensorkeys):
+        """
+        Return a dict with the signature of the files of each sensor, it
+        changes whenever the stored data of that sensor may have changed
+        """
+        partitions = tuple(_signature(path) for year, path in self.partitions())
+        return {sensorkey: (partitions, _signature(self.legacy.path(sensorkey))) for sensorkey in sensorkeys}
+
+    def files(self, sensorkeys):
+        """
+        Return the paths of the existing files that may hold these sensors
+        """
+        return [path for year, path in self.partitions()] + self.legacy.files(sensorkeys)
+
+    def sensors(self):
+        """
+        Return the keys of all sensors in the partitions or in pickles not migrated yet
+        """
+        res = set(self.legacy.sensors())
+        for year, path in self.partitions():
+            res.update(self.columns(path))
+        return sorted(res)
+
+    def _read_partition(self, path, columns=None):
+        if columns is not None:
+            columns = [self.INDEX] + columns
+        df = self._pq.read_table(path, columns=columns).to_pandas()
+        df = df.set_index(self.INDEX)
+        df.index.name = None
+        return df
+
+    def _write_partition(self, path, df):
+        df = df.copy()
+        df.index.name = self.INDEX
+        table = self._pa.Table.from_pandas(df.reset_index(), preserve_index=False)
+        _atomic_write(path, lambda f: self._pq.write_table(table, f, compression=self.compression))
+
+    def read(self, sensorkeys, start=None, end=None):
+        """
+        Return a dataframe with a column for each sensor that has cached data
+
+        Parameters
+        ----------
+        sensorkeys : list of str
+        start, end : tz-aware pandas Timestamp, optional
+            Only return the days between start and end.  Partitions outside
+            of this range are not read.
+
+        Returns
+        -------
+        df : pandas DataFrame, empty if none of the sensors has cached data
+        """
+        self._migrate(sensorkeys)
+
+        dfs = []
+        for year, path in self.partitions():
+            if start is not None and year < start.tz_convert('UTC').year:
+                continue
+            if end is not None and year > end.tz_convert('UTC').year:
+                continue
+            stored = self.columns(path)
+            columns = [sensorkey for sensorkey in sensorkeys if sensorkey in stored]
+            if columns:
+                dfs.append(self._read_partition(path, columns))
+        if not dfs:
+            return pd.DataFrame()
+
+        df = _truncate(pd.concat(dfs), start, end).dropna(how='all')
+        return df[[sensorkey for sensorkey in sensorkeys if sensorkey in df.columns]]
+
+    def write(self, df):
+        """
+        Replace the stored data of each sensor (column) in df
+        """
+        df = df.copy()
+        if df.index.tz is None:
+            df.index = df.index.tz_localize('Europe/Brussels')
+        df.index = df.index.tz_convert('UTC')
+
+        # all partitions holding one of the sensors are rewritten, also
+        # those for which df has no data anymore
+        years = set(df.index.year)
+        for year, path in self.partitions():
+            if set(df.columns) & set(self.columns(path)):
+                years.add(year)
+
+        for year in sorted(years):
+            path = self.path(year)
+            df_year = df[df.index.year == year]
+            if os.path.exists(path):
+                # Cache.update passes the whole history of a sensor, most partitions are unchanged
+                stored = [c for c in df.columns if c in self.columns(path)]
+                if _same_data(self._read_partition(path, stored), df_year):
+                    continue
+                df_old = self._read_partition(path)
+                df_old = df_old.drop([c for c in df.columns if c in df_old.columns], axis=1)
+                df_year = pd.concat([df_old, df_year], axis=1)
+            df_year = df_year.dropna(axis=1, how='all').dropna(how='all').sort_index()
+
+            if len(df_year.columns) == 0:
+                if os.path.exists(path):
+                    os.remove(path)
+            else:
+                self._write_partition(path, df_year)
+
+        self._remove_legacy(df.columns)
+
+
+def _same_data(df_old, df_new):
+    """
+    Return True if two dataframes hold the same values on the same days,
+    ignoring empty rows and columns, the order of the columns and the dtype
+    """
+    df_old = df_old.dropna(axis=1, how='all').dropna(how='all')
+    df_new = df_new.dropna(axis=1, how='all').dropna(how='all')
+    if set(df_old.columns) != set(df_new.columns) or not df_old.sort_index().index.equals(df_new.sort_index().index):
+        return False
+    columns = list(df_old.columns)
+    old = df_old.sort_index()[columns].values.astype(float)
+    new = df_new.sort_index()[columns].values.astype(float)
+    return bool(np.array_equal(np.isnan(old), np.isnan(new)) and (old[~np.isnan(old)] == new[~np.isnan(new)]).all())
+
+
+class MmapStorage(ColumnarStorage):
+    """
+    Storage with all sensors of a variable in a single matrix of float64 that
+    is memory-mapped when reading: folder/variable/values.<n>.npy
+
+    Rows are consecutive days, numbered in days.<n>.npy (int32, days since
+    1970-01-01 in the timezone of the storage).  Columns are sensors, the
+    side index folder/variable/index.json maps sensor keys to columns and
+    points to the current generation <n> of the files.
+
+    Reads return dataframes backed by the memory-map, so processes reading the
+    same variable share one physical copy.  This is only possible without
+    copying if the requested sensors are consecutive columns (eg. all sensors).
+    Every write creates a new generation of the files, so existing memory-maps
+    stay valid.
+    """
+
+    EPOCH = pd.Timestamp('1970-01-01')
+
+    def __init__(self, folder, variable, codec=None):
+        if codec is not None:
+            raise ValueError("The mmap storage can not be compressed, it is mapped into memory as it is")
+        super(MmapStorage, self).__init__(folder, variable)
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    def _index(self):
+        """
+        Return the side index, or None if nothing is stored yet
+        """
+        try:
+            with open(self.path('index.json'), 'r') as f:
+                return json.load(f)
+        except (IOError, OSError):
+            return None
+
+    def _load(self, index):
+        """
+        Return the memory-mapped (days, values) of the generation in the index
+        """
+        days = np.load(self.path('days.{}.npy'.format(index['generation'])), mmap_mode='r')
+        values = np.load(self.path('values.{}.npy'.format(index['generation'])), mmap_mode='r')
+        return days, values
+
+    def _day_numbers(self, index, tz):
+        """
+        Return the day numbers of a tz-aware DatetimeIndex at midnight in tz
+        """
+        local = index.tz_convert(tz).tz_localize(None)
+        if not (local == local.normalize()).all():
+            raise ValueError("The mmap storage needs daily values at midnight {}".format(tz))
+        return ((local - self.EPOCH) // pd.Timedelta(days=1)).values.astype(np.int32)
+
+    def signatures(self, sensorkeys):
+        """
+        Return a dict with the signature of the files of each sensor, it
+        changes whenever the stored data of that sensor may have changed
+        """
+        index = _signature(self.path('index.json'))
+        return {sensorkey: (index, _signature(self.legacy.path(sensorkey))) for sensorkey in sensorkeys}
+
+    def files(self, sensorkeys):
+        """
+        Return the paths of the existing files holding these sensors
+        """
+        index = self._index()
+        if index is None:
+            return self.legacy.files(sensorkeys)
+        return [self.path(name.format(index['generation'])) for name in ['index.json', 'days.{}.npy', 'values.{}.npy']
+                ] + self.legacy.files(sensorkeys)
+
+    def sensors(self):
+        """
+        Return the keys of all sensors in the matrix or in pickles not migrated yet
+        """
+        index = self._index()
+        res = set(self.legacy.sensors())
+        if index is not None:
+            res.update(index['sensors'])
+        return sorted(res)
+
+    def read(self, sensorkeys, start=None, end=None):
+        """
+        Return a dataframe with a column for each sensor that has cached data
+
+        All days between the first and last stored day are returned, also the
+        ones without data for the requested sensors.
+
+        Parameters
+        ----------
+        sensorkeys : list of str
+        start, end : tz-aware pandas Timestamp, optional
+            Only return the days between start and end
+
+        Returns
+        -------
+        df : pandas DataFrame, empty if none of the sensors has cached data
+        """
+        self._migrate(sensorkeys)
+        index = self._index()
+        if index is None:
+            return pd.DataFrame()
+
+        columns = dict((sensor, i) for i, sensor in enumerate(index['sensors']))
+        sensorkeys = [sensorkey for sensorkey in sensorkeys if sensorkey in columns]
+        if not sensorkeys:
+            return pd.DataFrame()
+
+        days, values = self._load(index)
+        first, last = 0, len(days)
+        if start is not None:
+            local = start.tz_convert(index['tz']).tz_localize(None)
+            day = (local.normalize() - self.EPOCH).days + int(local != local.normalize())
+            first = min(max(day - int(days[0]), 0), len(days))
+        if end is not None:
+            local = end.tz_convert(index['tz']).tz_localize(None)
+            day = (local.normalize() - self.EPOCH).days
+            last = min(max(day - int(days[0]) + 1, first), len(days))
+
+        cols = [columns[sensorkey] for sensorkey in sensorkeys]
+        if cols == list(range(cols[0], cols[0] + len(cols))):
+            # consecutive columns: a view on the memory-map
+            block = values[first:last, cols[0]:cols[0] + len(cols)]
+        else:
+            block = values[first:last][:, cols]
+
+        dayindex = pd.DatetimeIndex(self.EPOCH + pd.to_timedelta(np.asarray(days[first:last]), unit='D'))
+        return pd.DataFrame(block, index=dayindex.tz_localize(index['tz']), columns=sensorkeys, copy=False)
+
+    def write(self, df):
+        """
+        Replace the stored data of each sensor (column) in df
+        """
+        index = self._index()
+        if index is None:
+            tz = 'Europe/Brussels' if df.index.tz is None else str(df.index.tz)
+            index = dict(generation=0, sensors=[], tz=tz)
+            days_old, values_old = np.zeros(0, dtype=np.int32), np.zeros((0, 0))
+        else:
+            days_old, values_old = self._load(index)
+
+        dayindex = df.index if df.index.tz is not None else df.index.tz_localize('Europe/Brussels')
+        days_new = self._day_numbers(dayindex, index['tz'])
+
+        sensors = index['sensors'] + [sensor for sensor in df.columns if sensor not in index['sensors']]
+        all_days = np.concatenate([days_old, days_new])
+        if len(all_days) == 0:
+            return
+        first = int(all_days.min())
+        # the widest type of the stored and the new values, at least float32 for the NaNs
+        dtype = np.result_type(np.float32, *([values_old.dtype] if len(days_old) else []) + list(df.dtypes))
+        values = np.full((int(all_days.max()) - first + 1, len(sensors)), np.nan, dtype=dtype)
+        if len(days_old):
+            values[int(days_old[0]) - first:int(days_old[-1]) - first + 1, :values_old.shape[1]] = values_old
+        for sensor in df.columns:
+            col = sensors.index(sensor)
+            values[:, col] = np.nan
+            values[days_new - first, col] = df[sensor].values
+
+        # remove sensors without data and days without data at the start and end
+        keep = ~np.isnan(values).all(axis=0)
+        sensors = [sensor for sensor, k in zip(sensors, keep) if k]
+        values = values[:, keep]
+        rows = np.where(~np.isnan(values).all(axis=1))[0]
+        if len(rows):
+            values = values[rows[0]:rows[-1] + 1]
+            first += int(rows[0])
+        else:
+            values = values[:0]
+        days = np.arange(first, first + len(values), dtype=np.int32)
+
+        # write a new generation, the index is replaced last
+        generation = index['generation'] + 1
+        _atomic_write(self.path('days.{}.npy'.format(generation)), lambda f: np.save(f, days))
+        _atomic_write(self.path('values.{}.npy'.format(generation)), lambda f: np.save(f, values))
+        _atomic_write(self.path('index.json'),
+                      lambda f: json.dump(dict(generation=generation, sensors=sensors, tz=index['tz']), f),
+                      mode='w')
+
+        for name in ['days.{}.npy', 'values.{}.npy']:
+            try:
+                os.remove(self.path(name.format(index['generation'])))
+            except OSError:
+                # still mapped by a reader on windows, or never written
+                pass
+
+        self._remove_legacy(df.columns)
+
+
+STORAGES = {'pickle': PickleStorage,
+            'parquet': ParquetStorage,
+            'mmap': MmapStorage}
+
+
+class Journal(object):
+    """
+    Append-only file with the dataframes passed to Cache.update: folder/variable.journal
+
+    The records are pickled one after the other and are applied in order on top
+    of the stored data until Cache.compact() folds them in.  Each record is
+    framed with its length and a crc32 of its bytes, and reading stops at the
+    first frame that is incomplete or damaged.  Cache appends while holding
+    the lock of the variable, and an append first cuts the file back to the
+    end of the last good record, so a record torn by a crash can not hide
+    the records written after it.
+    """
+
+    HEADER = struct.Struct('<QI')  # length and crc32 of the pickled record
+
+    def __init__(self, folder, variable):
+        self.path = os.path.join(folder, variable + '.journal')
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def signature(self):
+        return _signature(self.path)
+
+    def append(self, df):
+        """
+        Add a dataframe (a column per sensor) at the end of the journal
+        """
+        data = pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL)
+        with open(self.path, "ab") as f:
+            end = self._end()
+            if f.tell() != end:
+                f.truncate(end)
+                f.seek(end)
+            f.write(self.HEADER.pack(len(data), zlib.crc32(data) & 0xffffffff) + data)
+
+    def records(self):
+        """
+        Return the list of dataframes in the journal, oldest first
+
+        Records from the first incomplete or damaged one on are ignored.
+        """
+        res = []
+        for data in self._frames():
+            try:
+                res.append(pickle.loads(data))
+            except Exception:
+                break
+        return res
+
+    def clear(self):
+        if self.exists():
+            os.remove(self.path)
+
+    def _frames(self):
+        """
+        Yield the bytes of the good records, up to the first bad frame
+        """
+        if not self.exists():
+            return
+        with open(self.path, "rb") as f:
+            while True:
+                header = f.read(self.HEADER.size)
+                if len(header) < self.HEADER.size:
+                    return
+                length, crc = self.HEADER.unpack(header)
+                data = f.read(length)
+                if length == 0 or len(data) < length or zlib.crc32(data) & 0xffffffff != crc:
+                    return
+                yield data
+
+    def _end(self):
+        """
+        Return the offset of the end of the last good record, checking the
+        frames without unpickling them
+        """
+        end = 0
+        for data in self._frames():
+            end += self.HEADER.size + len(data)
+        return end
+
+
+class FrameLRU(object):
+    """
+    In-memory least-recently-used store for the cached data of single sensors
+
+    Entries are kept with the signature of the files they were read from and
+    are only returned while that signature is unchanged.  The total memory
+    use of the stored dataframes is kept below max_bytes.
+
+    Set Cache.lru to an instance of this class to use it for all Cache objects
+    in the process.
+    """
+
+    def __init__(self, max_bytes=256 * 2**20):
+        """
+        Arguments
+        ---------
+        max_bytes : int, default 256 MiB
+            Memory budget for all stored dataframes
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return """
+    FrameLRU
+    {} dataframes, {} of {} bytes
+    {} hits, {} misses
+    """.format(len(self._frames),
+               self.nbytes,
+               self.max_bytes,
+               self.hits,
+               self.misses
+               )
+
+    def __len__(self):
+        return len(self._frames)
+
+    def get(self, key, signature):
+        """
+        Return the dataframe stored for key, or None if there is none or if it
+        was stored with another signature
+        """
+        with self._lock:
+            entry = self._frames.get(key)
+            if entry is None or entry[0] != signature:
+                self.misses += 1
+                return None
+            self._frames.pop(key)
+            self._frames[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, signature, df):
+        """
+        Store a dataframe and evict the least recently used ones if needed
+        """
+        nbytes = int(df.memory_usage(index=True, deep=True).sum())
+        with self._lock:
+            self._pop(key)
+            if nbytes > self.max_bytes:
+                return
+            self._frames[key] = (signature, df, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                self._pop(next(iter(self._frames)))
+
+    def invalidate(self, folder, variable, sensorkeys=None):
+        """
+        Remove the entries of these sensors (default all) of a variable
+        """
+        with self._lock:
+            for key in list(self._frames):
+                if key[:2] == (folder, variable) and (sensorkeys is None or key[2] in sensorkeys):
+                    self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self.nbytes = 0
+
+    def _pop(self, key):
+        entry = self._frames.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[2]
+
+
+class ResultCache(object):
+    """
+    Memory and disk cache for the results of Sensor.get_data
+
+    A result is stored with the watermark of the sensor (the epoch of its
+    last data point) at the time it was fetched.  It is returned as long as
+    the watermark did not change, or if the watermark had already passed
+    the tail of the query: new data can not change the result then.
+
+    The memory use of the stored series is kept below max_bytes.  With a
+    folder, the results are also pickled there, so they survive the process.
+    The folder is not cleaned up automatically, use clear().
+
+    Set Sensor.result_cache to an instance of this class to use it for all
+    sensors in the process.
+    """
+
+    def __init__(self, max_bytes=256 * 2**20, folder=None):
+        """
+        Arguments
+        ---------
+        max_bytes : int, default 256 MiB
+            Memory budget for all stored series
+        folder : str, optional
+            Folder for the pickled results, none if not given
+        """
+        self.max_bytes = max_bytes
+        self.folder = folder
+        if folder is not None and not os.path.exists(folder):
+            os.makedirs(folder)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return """
+    ResultCache
+    {} results, {} of {} bytes
+    {} hits, {} misses
+    """.format(len(self._results),
+               self.nbytes,
+               self.max_bytes,
+               self.hits,
+               self.misses
+               )
+
+    def __len__(self):
+        return len(self._results)
+
+    def get(self, key, tail, watermark, compute):
+        """
+        Return the stored result for key if it is still valid, else compute
+        and store it
+
+        Arguments
+        ---------
+        key : tuple
+            The sensor and all arguments of the query
+        tail : int
+            End of the query, in epochs
+        watermark : callable
+            Returns the current watermark of the sensor, in epochs (or None)
+        compute : callable
+            Returns the result, a Pandas Series with attribute unit
+        """
+        entry = self._get(key)
+        current = None
+        if entry is not None:
+            stored = entry[0]
+            if stored is not None and stored >= tail:
+                valid = True
+            else:
+                current = watermark()
+                valid = stored == current
+            if valid:
+                with self._lock:
+                    self.hits += 1
+                return self._series(entry)
+        else:
+            current = watermark()
+
+        with self._lock:
+            self.misses += 1
+        series = compute()
+        entry = (current, series.copy(), getattr(series, 'unit', None))
+        self._put(key, entry)
+        if self.folder is not None:
+            _atomic_write(self._path(key), lambda f: pickle.dump((key, entry), f, protocol=pickle.HIGHEST_PROTOCOL))
+        return series
+
+    def clear(self):
+        """
+        Remove all stored results, also from the folder
+        """
+        with self._lock:
+            self._results.clear()
+            self.nbytes = 0
+        if self.folder is not None:
+            for filename in os.listdir(self.folder):
+                if filename.endswith('.pkl'):
+                    os.remove(os.path.join(self.folder, filename))
+
+    def _path(self, key):
+        return os.path.join(self.folder, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.pkl')
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._results.pop(key, None)
+            if entry is not None:
+                self._results[key] = entry
+                return entry[:3]
+        if self.folder is None:
+            return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                stored_key, entry = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if stored_key != key:
+            return None
+        self._put(key, entry)
+        return entry
+
+    def _put(self, key, entry):
+        nbytes = int(entry[1].memory_usage(index=True, deep=True))
+        with self._lock:
+            self._pop(key)
+            if nbytes > self.max_bytes:
+                return
+            self._results[key] = entry + (nbytes,)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                self._pop(next(iter(self._results)))
+
+    def _pop(self, key):
+        entry = self._results.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[3]
+
+    @staticmethod
+    def _series(entry):
+        # a copy, so the caller can not change the stored result
+        series = entry[1].copy()
+        series.unit = entry[2]
+        return series
+
+
+class RollupStore(object):
+    """
+    Hourly values of the raw tmpo series of sensors, on disk
+
+    For each sensor the raw series is interpolated at every whole hour (UTC),
+    like Sensor.get_data does when it resamples, and the epochs of the raw
+    points around each hour are kept with it.  With those, get() returns the
+    series of get_data for any rule of whole hours that divides a day ('h',
+    '3h', 'D', ...), without reading the raw data: a year of hourly values is
+    a few hundred kB.
+
+    update() adds the hours after the last stored raw point, so it only reads
+    the new data from tmpo, which is expected to grow at the end only.
+    Houseprint.sync_tmpos calls it for each synced sensor.
+
+    Set Sensor.rollup_store to an instance of this class to serve the
+    coarse resamples of Fluksosensor.get_data from it.
+    """
+
+    HOUR = 3600  # in seconds
+    DAY = 86400
+
+    def __init__(self, folder):
+        """
+        Arguments
+        ---------
+        folder : str
+            Folder for the files of the sensors, one per sensor
+        """
+        self.folder = folder
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return """
+    RollupStore
+    {} sensors in {}
+    {} hits, {} misses
+    """.format(len([f for f in os.listdir(self.folder) if f.endswith('.npz')]),
+               self.folder,
+               self.hits,
+               self.misses
+               )
+
+    def update(self, key, tmpos):
+        """
+        Add the hours after the last stored raw point of a sensor.  The first
+        update reads the whole history of the sensor.
+
+        Arguments
+        ---------
+        key : str
+            Sensor key (tmpo sid)
+        tmpos : tmpo session
+
+        Returns
+        -------
+        int : number of hours added
+        """
+        rollup = self._load(key)
+        watermark = tmpos.last_timestamp(sid=key, epoch=True)
+        if rollup is not None and rollup['watermark'] == watermark:
+            return 0
+
+        # the last raw point is read again, to interpolate up to the next one
+        head = 0 if rollup is None else int(rollup['last_raw'])
+        raw = tmpos.series(sid=key, head=head, tail=2147483647).dropna()
+        if raw.empty:
+            return 0
+        if not raw.index.is_monotonic_increasing:
+            raw = raw.sort_index()
+
+        # interpolate on the epochs in ns, exactly like the resampling of Sensor.get_data
+        epochs_ns = raw.index.values.astype('datetime64[ns]').astype(np.int64)
+        epochs = epochs_ns // 10**9
+        if rollup is None:
+            start = epochs[0] - epochs[0] % self.HOUR
+            hours = np.arange(start, epochs[-1] + 1, self.HOUR)
+        else:
+            start = int(rollup['start'])
+            hours = np.arange(start + len(rollup['values']) * self.HOUR, epochs[-1] + 1, self.HOUR)
+
+        values = np.interp(hours * 10**9, epochs_ns, raw.values.astype(float))
+        values[hours < epochs[0]] = np.nan
+        after = epochs[np.searchsorted(epochs, hours, side='left')]
+        i = np.searchsorted(epochs, hours, side='right') - 1
+        before = np.where(i >= 0, epochs[np.maximum(i, 0)], -1)
+
+        if rollup is not None:
+            values = np.concatenate([rollup['values'], values])
+            after = np.concatenate([rollup['after'], after])
+            before = np.concatenate([rollup['before'], before])
+        self._save(key, dict(start=start, last_raw=epochs[-1], watermark=-1 if watermark is None else watermark,
+                             unit=str(getattr(raw.index, 'unit', 'ns')), values=values, after=after, before=before))
+        return len(hours)
+
+    def get(self, key, tmpos, head, tail, rule, diff=False):
+        """
+        Return the resampled series of a sensor from head to tail, identical
+        to the one of the raw tmpo series, or None if the store does not
+        cover the query
+
+        A query is covered if head and tail are whole hours within the
+        stored hours, or outside the stored raw data.  A tail after the last
+        stored raw point also needs the store to be up to date with tmpos.
+
+        Arguments
+        ---------
+        key : str
+            Sensor key (tmpo sid)
+        tmpos : tmpo session
+        head, tail : int
+            Epochs, both included like tmpo does
+        rule : str
+            Pandas frequency
+        diff : bool
+            If True, the series is differentiated
+
+        Returns
+        -------
+        Pandas Series, in UTC and in the unit of the raw data, or None
+        """
+        try:
+            step = to_offset(rule).nanos // 10**9
+        except (AttributeError, ValueError):
+            step = None
+        rollup = None if step is None or step % self.HOUR or self.DAY % step else self._load(key)
+        series = None if rollup is None else self._get(rollup, key, tmpos, head, tail, rule, step, diff)
+        if series is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return series
+
+    def clear(self):
+        """
+        Remove the files of all sensors
+        """
+        for filename in os.listdir(self.folder):
+            if filename.endswith('.npz'):
+                os.remove(os.path.join(self.folder, filename))
+
+    def _get(self, rollup, key, tmpos, head, tail, rule, step, diff):
+        start, last_raw = int(rollup['start']), int(rollup['last_raw'])
+        values, after, before = rollup['values'], rollup['after'], rollup['before']
+        end = start + (len(values) - 1) * self.HOUR
+        first_raw = int(after[0])
+
+        # the first and last raw point of the query
+        if head <= first_raw:
+            first = first_raw
+        elif head % self.HOUR == 0 and head <= end:
+            first = int(after[(head - start) // self.HOUR])
+        else:
+            return None
+        if tail >= last_raw:
+            watermark = tmpos.last_timestamp(sid=key, epoch=True)
+            if rollup['watermark'] != (-1 if watermark is None else watermark):
+                return None
+            last = last_raw
+        elif tail < first_raw:
+            last = -1
+        elif tail % self.HOUR == 0:
+            last = int(before[(tail - start) // self.HOUR])
+        else:
+            return None
+        if last < first:
+            return pd.Series([], dtype=float, name=key)
+
+        # the bins of resample(rule) from the first to the last raw point, without extrapolation
+        edges = np.arange(first - first % step, last + 1, step)
+        res = np.full(len(edges), np.nan)
+        inside = edges >= first
+        res[inside] = values[(edges[inside] - start) // self.HOUR]
+        if diff:
+            res = np.diff(res, prepend=np.nan)
+
+        index = pd.date_range(start=pd.Timestamp(int(edges[0]) * 10**9, tz='UTC'), periods=len(edges), freq=rule)
+        if hasattr(index, 'as_unit'):
+            index = index.as_unit(str(rollup['unit']))
+        return pd.Series(res, index=index, name=key)
+
+    def _path(self, key):
+        return os.path.join(self.folder, key + '.npz')
+
+    def _load(self, key):
+        try:
+            with np.load(self._path(key)) as f:
+                return dict((name, f[name]) for name in f.files)
+        except (IOError, OSError):
+            return None
+
+    def _save(self, key, rollup):
+        _atomic_write(self._path(key), lambda f: np.savez(f, **rollup))
+
+
+class CacheStats(object):
+    """
+    Counters and latency histograms of the Cache operations, per variable
+
+    For each variable and operation (read, write, check_df, combine, ...) it
+    counts the calls, files, bytes and rows involved and the time spent.
+    The latencies are also counted in buckets with the upper limits in
+    BUCKETS (in seconds).
+
+    Set Cache.stats to an instance of this class to collect them for all
+    Cache objects in the process, and use dump() to save them as json, eg.
+    at the end of a recipe.
+    """
+
+    BUCKETS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, float('inf')]
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return """
+    CacheStats
+    {} variables, {} calls, {:.3f} s
+    """.format(len(set(variable for variable, operation in self._stats)),
+               sum(entry['calls'] for entry in self._stats.values()),
+               sum(entry['seconds'] for entry in self._stats.values())
+               )
+
+    def measure(self, variable, operation):
+        """
+        Return a context manager that records the duration of its block.
+        Set its files, bytes and rows attributes (or call add_files) in the
+        block to record these too.
+        """
+        return _Measurement(self, variable, operation)
+
+    def record(self, variable, operation, seconds, files=0, bytes=0, rows=0):
+        """
+        Add a single call of an operation
+        """
+        with self._lock:
+            entry = self._stats.get((variable, operation))
+            if entry is None:
+                entry = dict(calls=0, seconds=0., max_seconds=0., files=0, bytes=0, rows=0,
+                             histogram=[0] * len(self.BUCKETS))
+                self._stats[(variable, operation)] = entry
+            entry['calls'] += 1
+            entry['seconds'] += seconds
+            entry['max_seconds'] = max(entry['max_seconds'], seconds)
+            entry['files'] += files
+            entry['bytes'] += bytes
+            entry['rows'] += rows
+            entry['histogram'][np.searchsorted(self.BUCKETS, seconds)] += 1
+
+    def to_dict(self):
+        """
+        Return the stats as {variable: {operation: {counter: value}}}
+        """
+        res = {}
+        with self._lock:
+            for (variable, operation), entry in self._stats.items():
+                entry = dict(entry, histogram=list(entry['histogram']))
+                res.setdefault(variable, {})[operation] = entry
+        return dict(buckets=[str(b) for b in self.BUCKETS], variables=res)
+
+    def to_frame(self):
+        """
+        Return the counters (without histograms) as a dataframe, indexed by
+        variable and operation
+        """
+        with self._lock:
+            keys = sorted(self._stats)
+            rows = [dict((k, v) for k, v in self._stats[key].items() if k != 'histogram') for key in keys]
+        index = pd.MultiIndex.from_tuples(keys, names=['variable', 'operation']) if keys else None
+        return pd.DataFrame(rows, index=index,
+                            columns=['calls', 'seconds', 'max_seconds', 'files', 'bytes', 'rows'])
+
+    def dump(self, path):
+        """
+        Save the stats as json
+        """
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1, sort_keys=True)
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+class _Measurement(object):
+    """
+    Context manager returned by CacheStats.measure
+    """
+
+    def __init__(self, stats, variable, operation):
+        self.stats = stats
+        self.variable = variable
+        self.operation = operation
+        self.files = 0
+        self.bytes = 0
+        self.rows = 0
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.record(self.variable, self.operation, time.time() - self._start,
+                          files=self.files, bytes=self.bytes, rows=self.rows)
+
+    def add_files(self, paths):
+        """
+        Count these files and their size
+        """
+        for path in paths:
+            signature = _signature(path)
+            if signature is not None:
+                self.files += 1
+                self.bytes += signature[1]
+
+
+class _NoMeasurement(object):
+    """
+    Does nothing in place of a _Measurement, when Cache.stats is not set
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def add_files(self, paths):
+        pass
+
+
+class Manifest(object):
+    """
+    Summary of the cached data per sensor: folder/variable.manifest.json
+
+    For each sensor it holds the first and last day, the number of rows and
+    the time of the last write, so these can be queried without reading data.
+    """
+
+    def __init__(self, folder, variable):
+        self.path = os.path.join(folder, variable + '.manifest.json')
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+    def save(self, entries):
+        _atomic_write(self.path, lambda f: json.dump(entries, f, indent=1, sort_keys=True), mode='w')
+
+    @staticmethod
+    def summarize(ts):
+        """
+        Return the manifest entry for a Series with the cached data of a sensor
+        """
+        return dict(first_day=ts.index.min().isoformat(),
+                    last_day=ts.index.max().isoformat(),
+                    rows=len(ts),
+                    written=pd.Timestamp('now', tz='UTC').isoformat())
+
 
 class Cache(object):
     """
     A class to handle daily aggregated data or intermediate results
-    
-    The file format for the data is result_sensor.csv
+
+    By default, the file format for the data is folder/variable_sensor.pkl.
+    With storage='parquet', all sensors are stored in yearly files
+    folder/variable/year.parquet.  With storage='mmap', all sensors are
+    stored in a single memory-mapped matrix in folder/variable/
+
+    Set Cache.lru = FrameLRU(max_bytes) to keep recently read data in memory
+    for all Cache objects in this process.  Set Cache.stats = CacheStats() to
+    measure the time, files, bytes and rows of the operations.
+
+    Several processes can use the same cache: files are replaced atomically,
+    writes hold an advisory lock per variable (folder/variable.lock) and
+    reads are retried when a file changes underneath them.
     """
-    
-    def __init__(self, variable, folder=None):
+
+    lru = None
+    stats = None
+
+    def __init__(self, variable, folder=None, storage='pickle', journal=False, codec=None, dtype=None):
         """
         Create a cache object specifically for the specified variable
-        
+
         Arguments
         ---------
         variable : str
@@ -39,7 +1482,28 @@ class Cache(object):
         folder : path
             Path where the files are stored
             If None, use the path specified in the opengrid configuration
-            
+        storage : 'pickle', 'parquet' or 'mmap'
+            'pickle' stores a file per sensor (default).
+            'parquet' stores all sensors in a columnar file per year
+            and needs pyarrow.
+            'mmap' stores all sensors in a matrix that is memory-mapped
+            when reading, get() then returns dataframes without copying.
+            For 'parquet' and 'mmap', existing pickles are migrated on first use.
+        journal : bool, default=False
+            If True, update() appends the new data to a journal instead of
+            rewriting the full history of each sensor.  Call compact() to fold
+            the journal into the stored data.  Reading always takes the journal
+            into account, whatever this setting.
+        codec : str, optional
+            Compression of the written data: 'zlib', 'bz2' and 'lzma' (standard
+            library), 'lz4', 'zstd' or 'blosc' (need the package of that name).
+            Data is read whatever codec it was written with.
+            The parquet storage supports 'zlib', 'lz4' and 'zstd', the mmap
+            storage no codec.  See opengrid.benchmarks.cache_codecs to compare them.
+        dtype : numpy dtype, optional
+            Type of the stored and returned values, eg. 'float32' to halve the
+            size of the cache.  By default the values are stored as given.
+
         """
         self.variable = variable
         if folder is None:
@@ -53,6 +1517,19 @@ class Cache(object):
         if not os.path.exists(self.folder):
             print("This folder does not exist: {}, it will be created".format(self.folder))
             os.mkdir(self.folder)
+
+        if storage not in STORAGES:
+            raise ValueError("Storage '{}' is not supported, use one of {}".format(storage, sorted(STORAGES)))
+        self.storage = storage
+        self.codec = codec
+        self.dtype = dtype
+        self._storage = STORAGES[storage](self.folder, self.variable, codec=codec)
+        self.journal = journal
+        self._journal = Journal(self.folder, self.variable)
+        self._manifest = Manifest(self.folder, self.variable)
+        self._lock = FileLock.get(os.path.join(self.folder, self.variable + '.lock'))
+        self._entries = None
+        self._entries_mtime = None
             
         print("Cache object created for variable: {}".format(self.variable))
 
@@ -72,18 +1549,131 @@ class Cache(object):
         df : tz-aware dataframe with cached daily results or empty dataframe.
         
         """
-        # Find the file and read into a dataframe
-        filename = self.variable + '_' + sensorkey + '.pkl'
-        path = os.path.join(self.folder, filename)
-        
-        if not os.path.exists(path):
-            #print("Could not find {}".format(path))
+        return self._read([sensorkey]).dropna()
+
+    def _read(self, sensorkeys, start=None, end=None):
+        """
+        Return a dataframe with a column for each of these sensors that has
+        cached data, with the journal (if any) applied on top of it.
+
+        If start and/or end (tz-aware Timestamps) are given, only these days
+        are read from disk when possible.
+
+        If Cache.lru is set, sensors are only read from disk if they are not
+        in the lru or if their files changed since.  The lru holds all days of
+        a sensor, start and end are then applied in memory.  The lru is not
+        used for the mmap storage, which does not copy the data into memory.
+        """
+        if Cache.lru is None or self.storage == 'mmap':
+            return self._read_files(sensorkeys, start, end)
+
+        journal = self._journal.signature()
+        signatures = self._storage.signatures(sensorkeys)
+        frames = {}
+        missing = []
+        for sensorkey in sensorkeys:
+            signature = (signatures[sensorkey], journal)
+            df = Cache.lru.get((self.folder, self.variable, sensorkey), signature)
+            if df is None:
+                missing.append(sensorkey)
+            else:
+                frames[sensorkey] = df
+
+        if missing:
+            df = self._read_files(missing)
+            for sensorkey in missing:
+                if sensorkey in df.columns:
+                    frames[sensorkey] = df[[sensorkey]].dropna()
+                else:
+                    frames[sensorkey] = pd.DataFrame()
+                Cache.lru.put((self.folder, self.variable, sensorkey), (signatures[sensorkey], journal),
+                              frames[sensorkey])
+
+        dfs = [_truncate(frames[sensorkey], start, end) for sensorkey in sensorkeys]
+        dfs = [df for df in dfs if not df.empty]
+        if dfs:
+            return pd.concat(dfs, axis=1)
+        else:
             return pd.DataFrame()
-        
-        df = pickle.load(open(path, "rb"))
-        if isinstance(df, pd.Series):
-            df = pd.DataFrame(df)
-        return df
+
+    def _read_files(self, sensorkeys, start=None, end=None):
+        """
+        Same as _read, without the lru
+        """
+        with self._measure('read') as m:
+            df = _retry(self._storage.read, sensorkeys, start, end)
+            m.rows = len(df)
+            if Cache.stats is not None:
+                m.add_files(self._storage.files(sensorkeys) + [self._journal.path])
+            if not self._journal.exists():
+                return df
+
+            for record in _retry(self._journal.records):
+                columns = [sensorkey for sensorkey in sensorkeys if sensorkey in record.columns]
+                if columns:
+                    df = self._combine(df, _truncate(record[columns], start, end))
+            if df.empty:
+                return df
+            df = df.dropna(how='all')
+            m.rows = len(df)
+            return df[[sensorkey for sensorkey in sensorkeys if sensorkey in df.columns]]
+
+    def _write_storage(self, df):
+        """
+        Replace the stored data of the sensors in df, and bring the lru and
+        the manifest up to date.  The caller holds the lock.
+        """
+        df = self._astype(df)
+        with self._measure('write') as m:
+            self._storage.write(df)
+            m.rows = len(df)
+            if Cache.stats is not None:
+                m.add_files(self._storage.files(df.columns))
+        self._invalidate(df.columns)
+        self._update_manifest(df)
+
+    def _append_journal(self, df):
+        """
+        Append df to the journal, and bring the lru and the manifest up to
+        date.  The caller holds the lock.
+        """
+        df = self._astype(df)
+        with self._measure('journal') as m:
+            size = os.path.getsize(self._journal.path) if self._journal.exists() else 0
+            self._journal.append(df)
+            m.rows = len(df)
+            m.files = 1
+            m.bytes = os.path.getsize(self._journal.path) - size
+        self._invalidate(df.columns)
+        self._update_manifest(df, replace=False)
+
+    def _astype(self, df):
+        """
+        Return df with the dtype of the cache, if it has one
+        """
+        if self.dtype is None or df.empty:
+            return df
+        return df.astype(self.dtype, copy=False)
+
+    def _measure(self, operation):
+        """
+        Return a context manager that records an operation in Cache.stats,
+        if it is set
+        """
+        if Cache.stats is None:
+            return _NoMeasurement()
+        return Cache.stats.measure(self.variable, operation)
+
+    def _combine(self, df_old, df_new):
+        """
+        Return df_old, updated with the values of df_new (will overwrite overlapping days)
+        """
+        with self._measure('combine') as m:
+            df_old = df_old.copy()
+            df_old.update(df_new)
+            df_res = df_old.combine_first(df_new)
+            m.rows = len(df_res)
+        return df_res
     
     
     def _write_single(self, df):
@@ -107,12 +1697,9 @@ class Cache(object):
 
         df_temp = df_temp.dropna()
 
-        sensor = df_temp.columns[0]
-        # Find the file and read into a dataframe
-        filename = self.variable + '_' + sensor + '.pkl'
-        path = os.path.join(self.folder, filename)
-
-        pickle.dump(df_temp, open(path, "wb"))
+        with self._lock:
+            self.compact()
+            self._write_storage(df_temp)
 
         return True
 
@@ -138,8 +1725,9 @@ class Cache(object):
         if isinstance(df, pd.Series):
             return self._write_single(df)
         else:
-            for sensor in df.columns:
-                self._write_single(df[sensor])
+            with self._lock:
+                self.compact()
+                self._write_storage(df)
             return True
     
     def get(self, sensors, start=None, end=None):
@@ -164,40 +1752,32 @@ class Cache(object):
         if not isinstance(sensors, list):
             raise TypeError("Sensors has to be a list with Sensor objects, not a {}".format(type(sensors)))
 
-        dfs = []
-        for sensor in sensors:
-            df = self._load(sensor.key)
-            if not df.empty:
-                dfs.append(df)
-        if dfs:
-            df = pd.concat(dfs, axis=1)
+        # the truncation is done while reading, tz-naive limits are local time
+        t_start, t_end = None, None
+        if start is not None:
+            t_start = misc.parse_date(start)
+            if t_start.tz is None:
+                t_start = t_start.tz_localize('Europe/Brussels')
+        if end is not None:
+            t_end = misc.parse_date(end)
+            if t_end.tz is None:
+                t_end = t_end.tz_localize('Europe/Brussels')
+
+        with self._measure('get') as m:
+            df = self._read([sensor.key for sensor in sensors], t_start, t_end)
+            m.rows = len(df)
+        if not df.empty:
             try:
                 df.index = df.index.tz_convert('Europe/Brussels')
             except TypeError:
                 df.index = df.index.tz_localize('Europe/Brussels')
+            # data written without a dtype, or combined with the journal
+            df = self._astype(df)
         else:
             print("No cached sensordata found.")
             df = pd.DataFrame()
 
-        if len(df) == 0:
-            return df
-        
-        if (start is None) & (end is None):
-            # no truncating
-            return df
-        
-        # truncate
-        if start is None:
-            t_start = misc.parse_date(0)
-        else:
-            t_start = misc.parse_date(start)
-        
-        if end is None:
-            t_end = misc.parse_date('21000101')
-        else:
-            t_end = misc.parse_date(end)
-            
-        return df.loc[t_start:t_end,:]
+        return df
    
     
     def check_df(self, df):
@@ -215,6 +1795,11 @@ class Cache(object):
         Return False when the dataframe is empty or when the index does not have a daily frequency
 
         """
+        with self._measure('check_df') as m:
+            m.rows = len(df)
+            return self._check_df(df)
+
+    def _check_df(self, df):
         if len(df) == 0:
             print("Empty dataframe")
             return False
@@ -262,12 +1847,17 @@ class Cache(object):
                 raise ValueError("pandas Series needs a name with sensor id")
             df_temp = pd.DataFrame(df)
 
-        # Find the file and read into a dataframe
-        sensor = df_temp.columns[0]
-        df_old = self._load(sensor) #
-        df_old.update(df_temp)
-        df_res = df_old.combine_first(df_temp)
-        self._write(df_res)
+        with self._lock, self._measure('update') as m:
+            m.rows = len(df_temp)
+            if self.journal:
+                self._append_journal(df_temp)
+                return True
+
+            # Find the file and read into a dataframe
+            sensor = df_temp.columns[0]
+            df_old = self._load(sensor) #
+            df_res = self._combine(df_old, df_temp)
+            self._write(df_res)
         return True
 
 
@@ -290,20 +1880,264 @@ class Cache(object):
         self.folder/result_sensor.csv. If such a file was already present,
         the values are updated with the ones provided in df (will overwrite
         overlapping days).
+        If the cache was created with journal=True, df is appended to the
+        journal instead.
         """
 
         if isinstance(df, pd.Series):
             return self._update_single(df)
         else:
-            for sensor in df.columns:
-                try:
-                    self._update_single(df[sensor])
-                except ValueError:
-                    pass
+            # all columns share the index, so they are all acceptable or not
+            if not self.check_df(df):
+                return True
+
+            with self._lock, self._measure('update') as m:
+                m.rows = len(df)
+                if self.journal:
+                    self._append_journal(df)
+                    return True
+
+                # read and write all sensors at once
+                df_old = self._read(list(df.columns))
+                df_res = self._combine(df_old, df)
+                self._write(df_res)
             return True
 
+    def compact(self):
+        """
+        Fold the journal into the stored data and remove it
+
+        Returns
+        -------
+        True if there was a journal to compact
+        """
+        with self._lock:
+            records = self._journal.records()
+            if not records:
+                self._journal.clear()
+                return False
+
+            with self._measure('compact'):
+                sensors = []
+                for record in records:
+                    sensors += [sensor for sensor in record.columns if sensor not in sensors]
+                df = self._read(sensors)
+                self._write_storage(df)
+                self._journal.clear()
+        return True
+
+    def _get_manifest(self):
+        """
+        Return a dict with the manifest entry of each sensor
+
+        Without a manifest file (eg. a cache written by an older version),
+        the entries are built from the cached data once.  They are saved
+        with the next write.
+        """
+        if self._manifest.exists():
+            mtime = os.path.getmtime(self._manifest.path)
+            if self._entries is None or self._entries_mtime != mtime:
+                self._entries = _retry(self._manifest.load)
+                self._entries_mtime = mtime
+            return self._entries
+
+        if self._entries is None or self._entries_mtime is not None:
+            sensors = self._storage.sensors()
+            for record in self._journal.records():
+                sensors += [sensor for sensor in record.columns if sensor not in sensors]
+            df = self._read(sensors)
+            self._entries = {}
+            for sensor in df.columns:
+                ts = df[sensor].dropna()
+                if not ts.empty:
+                    self._entries[sensor] = Manifest.summarize(ts)
+            self._entries_mtime = None
+        return self._entries
+
+    def _update_manifest(self, df, replace=True):
+        """
+        Bring the manifest entries of the sensors in df up to date
+
+        Parameters
+        ----------
+        df : pandas DataFrame
+            A column per sensor
+        replace : bool, default=True
+            If True, df is all cached data of these sensors.
+            If False, df has been added to the cached data (journal).  The
+            number of rows then only counts the days outside of the
+            previous first and last day; compact() makes it exact again.
+        """
+        entries = dict(self._get_manifest())
+        for sensor in df.columns:
+            ts = df[sensor].dropna()
+            if ts.empty:
+                if replace:
+                    entries.pop(sensor, None)
+                continue
+
+            entry = Manifest.summarize(ts)
+            if not replace and sensor in entries:
+                old = entries[sensor]
+                first_day, last_day = pd.Timestamp(old['first_day']), pd.Timestamp(old['last_day'])
+                new_days = ts[(ts.index < first_day) | (ts.index > last_day)]
+                entry['first_day'] = min(first_day, ts.index.min()).isoformat()
+                entry['last_day'] = max(last_day, ts.index.max()).isoformat()
+                entry['rows'] = old['rows'] + len(new_days)
+            entries[sensor] = entry
+
+        self._manifest.save(entries)
+        # what was saved is what the next query would load
+        self._entries = entries
+        self._entries_mtime = os.path.getmtime(self._manifest.path)
+
+    def _invalidate(self, sensorkeys):
+        """
+        Drop these sensors from the lru after this process wrote them
+        """
+        if Cache.lru is not None:
+            Cache.lru.invalidate(self.folder, self.variable, list(sensorkeys))
+
+    def sensors(self):
+        """
+        Return a list with the keys of all sensors with cached data
+        """
+        return sorted(self._get_manifest().keys())
+
+    def coverage(self, sensors=None):
+        """
+        Return a dataframe with the first day, last day, number of rows and
+        time of the last write of the cached data of each sensor
+
+        Arguments
+        ---------
+        sensors : list with Sensor objects, optional
+            If None, return all sensors with cached data
+
+        Returns
+        -------
+        df : pandas DataFrame
+            Indexed by sensor key, sensors without cached data are left out
+        """
+        entries = self._get_manifest()
+        if sensors is None:
+            keys = sorted(entries.keys())
+        else:
+            keys = [sensor.key for sensor in sensors if sensor.key in entries]
+
+        df = pd.DataFrame([entries[key] for key in keys], index=keys,
+                          columns=['first_day', 'last_day', 'rows', 'written'])
+        for column in ['first_day', 'last_day', 'written']:
+            df[column] = [self._parse_timestamp(x) for x in df[column]]
+        return df
+
+    def last_day(self, sensor):
+        """
+        Return the last cached day of this sensor, without reading its data
+
+        Arguments
+        ---------
+        sensor : Sensor object
+
+        Returns
+        -------
+        pandas Timestamp or None if there is no cached data for this sensor
+        """
+        entry = self._get_manifest().get(sensor.key)
+        if entry is None:
+            return None
+        return self._parse_timestamp(entry['last_day'])
+
+    def _parse_timestamp(self, s):
+        """
+        Return a Timestamp in the timezone used by get()
+        """
+        ts = pd.Timestamp(s)
+        if ts.tz is None:
+            return ts.tz_localize('Europe/Brussels')
+        return ts.tz_convert('Europe/Brussels')
+
+
+# Rough peak memory use per minute of data of a single sensor while it is
+# analysed: the raw tmpo series, the resampled index and their copies.
+BYTES_PER_MINUTE = 100
+
+# Number of days read at once in chunk mode if there is no memory limit
+DEFAULT_WINDOW = 28
 
-def cache_results(hp, sensors, resultname, AnalysisClass, chunk=True, **kwargs):
+
+def _window_days(max_memory, workers=None):
+    """
+    Return the number of days to read at once in chunk mode, such that the
+    sensors analysed at the same time stay within max_memory bytes
+    """
+    if max_memory is None:
+        return DEFAULT_WINDOW
+    day = 24 * 60 * BYTES_PER_MINUTE * (workers or 1)
+    return max(1, int(max_memory // day))
+
+
+def _analyse(hp, sensor, last_day, analyses, chunk, window, dtype=None):
+    """
+    Yield the results of the analyses on the data of a sensor since last_day,
+    as a dict with the result of each analysis by resultname.
+    The data is fetched once for all analyses.
+    """
+    if chunk:
+        # the raw data is read for a window of days at once, and split
+        # into single days, full resolution
+        days = pd.DatetimeIndex(start=last_day, freq='D', end=pd.Timestamp.today())
+        for d, df_new in hp.get_data_by_day(sensors=[sensor], days=days, window=window, dtype=dtype):
+            # apply the methods
+            yield {name: AnalysisClass(df_new, **kwargs).result
+                   for name, (AnalysisClass, kwargs) in analyses.items()}
+    else:
+        # get new data, full resolution
+        df_new = hp.get_data(sensors=[sensor], head=last_day, dtype=dtype)
+
+        # apply the methods
+        yield {name: AnalysisClass(df_new, **kwargs).result
+               for name, (AnalysisClass, kwargs) in analyses.items()}
+
+
+def _estimate_memory(last_day, chunk, window):
+    """
+    Return the estimated peak memory in bytes to analyse a sensor since last_day
+    """
+    minutes = (pd.Timestamp('now', tz='UTC') - last_day).total_seconds() / 60
+    if chunk:
+        minutes = min(minutes, window * 24 * 60)
+    return int(minutes * BYTES_PER_MINUTE)
+
+
+# houseprint with its own tmpo session in each worker process of cache_results
+_worker_hp = None
+
+
+def _init_worker(hp, tmpo_path):
+    global _worker_hp
+    import tmpo
+    hp.init_tmpo(tmpos=tmpo.Session(tmpo_path))
+    _worker_hp = hp
+
+
+def _analyse_in_worker(sensorkey, last_day, analyses, chunk, window, dtype=None):
+    """
+    Run _analyse in a worker process
+
+    Returns
+    -------
+    (list with results, None) or ([], traceback) if the analysis failed
+    """
+    try:
+        sensor = _worker_hp.find_sensor(sensorkey)
+        return list(_analyse(_worker_hp, sensor, last_day, analyses, chunk, window, dtype)), None
+    except Exception:
+        return [], traceback.format_exc()
+
+
+def cache_results(hp, sensors, resultname, AnalysisClass=None, chunk=True, workers=None, max_memory=None,
+                  dtype=None, folder=None, **kwargs):
     """
     Run an analysis on a set of sensors and cache the results
 
@@ -313,12 +2147,34 @@ def cache_results(hp, sensors, resultname, AnalysisClass, chunk=True, **kwargs):
         Each element is a Sensor object with attribute 'key' as sensor_id
     AnalysisClass : object
         Class from the analysis library for the doing the analysis
-    resultname : string
-        Name of the cached variable, eg. elect_standby or water_daily_max
+    resultname : string or dict
+        Name of the cached variable, eg. elect_standby or water_daily_max.
+        To run several analyses on the same data, pass a dict with
+        {resultname: (AnalysisClass, kwargs)} instead, and no AnalysisClass
+        or kwargs.  The data of each sensor is then fetched only once, from
+        the earliest last cached day of all these variables.
     kwargs : dict
         Additional keyword arguments are passed to the instantiation of the analysis class
     chunk : boolean, default=True
-        If True, cache day_by_day to reduce memory use.
+        If True, cache day_by_day to reduce memory use.  The raw data is
+        read for a window of days at once and split into days in memory.
+        The window is sized to max_memory, or DEFAULT_WINDOW days without it.
+    workers : int, optional
+        If given, the sensors are analysed in this number of processes, each
+        with its own tmpo session.  The results are written to the cache by
+        this process only.  Failures are reported per sensor instead of raised.
+    max_memory : int, optional
+        Budget in bytes for the sensors that are analysed at the same time.
+        The memory use of a sensor is estimated from the number of days to
+        fetch at once, see BYTES_PER_MINUTE.  With workers, a sensor stays
+        in the budget until its results are written by this process, one
+        sensor at a time.  If a worker dies (eg. killed for lack of memory),
+        the sensors running at that moment fail and the others continue in
+        new workers.
+    dtype : numpy dtype, optional
+        Type of the fetched data and of the cached results, eg. 'float32'
+    folder : path, optional
+        Folder of the caches, by default the one in the opengrid.cfg
 
     Returns
     -------
@@ -331,40 +2187,108 @@ def cache_results(hp, sensors, resultname, AnalysisClass, chunk=True, **kwargs):
     # Therefore, we create a for loop over the sensor ids
     # update: to reduce RAM use, we add another loop to run over the days
 
-    import importlib
-    cache = Cache(variable=resultname)
+    if isinstance(resultname, dict):
+        if AnalysisClass is not None or kwargs:
+            raise ValueError("Pass the AnalysisClass and kwargs in the resultname dict")
+        analyses = resultname
+    else:
+        if AnalysisClass is None:
+            raise ValueError("AnalysisClass is required")
+        analyses = {resultname: (AnalysisClass, kwargs)}
+    caches = {name: Cache(variable=name, folder=folder, dtype=dtype) for name in analyses}
+    names = ', '.join(analyses)
 
-    for sensor in tqdm(sensors):
-        # Get whatever is available as cache
-        # and only extract timeseries from tmpos since the last day
-        df_cached = cache.get([sensor])
-        try:
-            last_day = df_cached.index[-1]
-        except IndexError:
-            last_day = pd.Timestamp('2013-01-01', tz='UTC')
+    # Get the last cached day from the manifests
+    # and only extract timeseries from tmpos since the last day
+    def get_last_day(sensor):
+        last_days = [cache.last_day(sensor) for cache in caches.values()]
+        if None in last_days:
+            return pd.Timestamp('2013-01-01', tz='UTC')
+        return min(last_days)
 
-        if chunk:
-            for d in pd.DatetimeIndex(start=last_day, freq='D', end=pd.Timestamp.today()):
-                # get new data for a single day, full resolution
-                df_new = hp.get_data(sensors = [sensor], head=d, tail=d + pd.Timedelta(days=1))
+    def update(results):
+        for name, df in results.items():
+            caches[name].update(df)
 
-                # apply the method
-                df_day = AnalysisClass(df_new, **kwargs).result
+    window = _window_days(max_memory, workers)
 
+    if workers is None:
+        for sensor in tqdm(sensors):
+            for results in _analyse(hp, sensor, get_last_day(sensor), analyses, chunk, window, dtype):
                 # cache the results
-                cache.update(df_day)
-        else:
-            # get new data, full resolution
-            df_new = hp.get_data(sensors=[sensor], head=last_day)
+                update(results)
+        return True
 
-            # apply the method
-            df_day = AnalysisClass(df_new, **kwargs).result
+    # the tmpo session can not be passed to other processes, each worker
+    # creates its own on the same database
+    tmpos = hp.get_tmpos()
+    tmpo_path = os.path.dirname(tmpos.home)
 
-            # cache the results
-            cache.update(df_day)
-    return True
+    def start_pool():
+        return ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(hp, tmpo_path))
 
+    pending = deque(sensors)
+    running = OrderedDict()  # future -> (sensor key, estimated memory), until its results are written
+    failures = OrderedDict()
+    progress = tqdm(total=len(sensors))
 
+    def finish(future):
+        """
+        Write the results of a sensor, return True if its worker died
+        """
+        key = running[future][0]
+        broken = False
+        try:
+            results, error = future.result()
+        except Exception as e:
+            # eg. a worker killed for lack of memory breaks the pool, and all sensors running in it
+            results, error = [], ''.join(traceback.format_exception_only(type(e), e))
+            broken = isinstance(e, BrokenProcessPool)
+        if error is None:
+            try:
+                for day_results in results:
+                    update(day_results)
+            except Exception:
+                error = traceback.format_exc()
+        del results
+        running.pop(future)
+        if error is not None:
+            failures[key] = error
+            progress.write("Caching {} failed for sensor {}:\n{}".format(names, key, error))
+        progress.update()
+        return broken
 
+    delattr(hp, '_tmpos')
+    pool = start_pool()
+    try:
+        while pending or running:
+            # start sensors as long as the memory budget allows, but at least one
+            while pending and len(running) < workers:
+                sensor = pending[0]
+                last_day = get_last_day(sensor)
+                memory = _estimate_memory(last_day, chunk, window)
+                if running and max_memory is not None and sum(m for k, m in running.values()) + memory > max_memory:
+                    break
+                pending.popleft()
+                future = pool.submit(_analyse_in_worker, sensor.key, last_day, analyses, chunk, window, dtype)
+                running[future] = (sensor.key, memory)
 
+            # the results are written here, one sensor at a time, and the sensor stays in the budget until then
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                broken |= finish(future)
+            if broken:
+                for future in list(running):
+                    finish(future)
+                pool.shutdown(wait=False)
+                pool = start_pool()
+    finally:
+        progress.close()
+        pool.shutdown(wait=False)
+        hp._tmpos = tmpos
 
+    if failures:
+        print("Caching {} failed for {} of {} sensors: {}".format(names, len(failures), len(sensors),
+                                                                  ', '.join(failures)))
+    return not failures
@@ -0,0 +1,264 @@
+"""
+Fetching the data of a list of sensors, sequentially or with a pool of threads.
+
+A tmpo session opens its SQLite connection for each call and keeps it on the
+session object, so one session can not be used by several threads at once.
+Each worker thread therefore gets its own session on the same database.
+"""
+
+import os
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from pandas.tseries.frequencies import to_offset
+import tmpo
+
+_local = threading.local()
+
+
+def session(tmpos):
+    """
+    Return the tmpo session to use in the current thread
+
+    In the calling thread this is tmpos itself, in a worker thread of
+    get_series it is a session of the worker on the same database.
+
+    Parameters
+    ----------
+    tmpos : tmpo session
+
+    Returns
+    -------
+    tmpo session
+    """
+    sessions = getattr(_local, 'sessions', None)
+    if sessions is None:
+        return tmpos
+    if tmpos.db not in sessions:
+        sessions[tmpos.db] = tmpo.Session(os.path.dirname(tmpos.home))
+    return sessions[tmpos.db]
+
+
+def _get_data(sensor, kwargs):
+    if not hasattr(_local, 'sessions'):
+        _local.sessions = {}
+    return sensor.get_data(**kwargs)
+
+
+def get_series(sensors, workers=None, **kwargs):
+    """
+    Return a list with sensor.get_data(**kwargs) for each sensor
+
+    Parameters
+    ----------
+    sensors : list of Sensor objects
+    workers : int, optional
+        Number of threads fetching and resampling the sensors concurrently.
+        If None or 1, the sensors are fetched one by one.
+    kwargs : passed to get_data
+
+    Returns
+    -------
+    list of Pandas Series, in the order of the sensors
+    """
+    sensors = list(sensors)
+    if not workers or workers == 1 or len(sensors) < 2:
+        return [sensor.get_data(**kwargs) for sensor in sensors]
+
+    resolve_sessions(sensors)
+    with ThreadPoolExecutor(max_workers=min(workers, len(sensors))) as executor:
+        return list(executor.map(_get_data, sensors, [kwargs] * len(sensors)))
+
+
+def resolve_sessions(sensors):
+    """
+    Resolve the tmpo sessions of the sensors in the calling thread, so a lazy
+    init_tmpo does not run in a worker thread
+    """
+    for sensor in sensors:
+        getattr(sensor, 'tmpos', None)
+
+
+def prefetch_map(func, items, depth=1):
+    """
+    Yield func(item) for each item, computing the next results in a
+    background thread while the caller processes the current one
+
+    At most depth results wait in the queue, so the memory stays bounded
+    when the caller is slower than func.  An exception in func is raised in
+    the caller.  When the caller stops early (break, or close() of the
+    generator), the background thread stops after the item it is computing.
+
+    Parameters
+    ----------
+    func : callable
+        Runs in the background thread, with its own tmpo sessions (see session)
+    items : iterable
+    depth : int, default=1
+        Number of results computed ahead of the caller
+
+    Yields
+    ------
+    func(item), in the order of the items
+    """
+    if depth < 1:
+        raise ValueError("The prefetch depth must be at least 1")
+    results = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(result):
+        while not stop.is_set():
+            try:
+                results.put(result, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def work():
+        _local.sessions = {}
+        try:
+            for item in items:
+                if stop.is_set() or not put(('result', func(item))):
+                    return
+        except Exception as e:
+            put(('error', e))
+            return
+        put(('done', None))
+
+    thread = threading.Thread(target=work, name='prefetch')
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            kind, value = results.get()
+            if kind == 'done':
+                return
+            elif kind == 'error':
+                raise value
+            yield value
+    finally:
+        stop.set()
+        thread.join()
+
+
+def resample_rule(resample):
+    """
+    Return the pandas rule for the resample argument of get_data
+    """
+    if resample == 'hour':
+        return 'H'
+    elif resample == 'day':
+        return 'D'
+    return resample
+
+
+def windows(edges):
+    """
+    Yield (start, end, last) for the windows between consecutive edges
+    """
+    edges = list(edges)
+    for i in range(len(edges) - 1):
+        yield edges[i], edges[i + 1], i == len(edges) - 2
+
+
+def window_edges(head, tail, window, resample='min'):
+    """
+    Return the edges of consecutive windows from head to tail
+
+    Parameters
+    ----------
+    head, tail : pandas Timestamps
+        Naive timestamps are taken as UTC
+    window : str or int
+        Pandas frequency of the windows, eg. 'D', '7D', 'W' or 'MS', or the
+        number of rows (of the resampled data) in a window
+    resample : str, default='min'
+        The resample argument of get_data, needed if window is an int
+
+    Returns
+    -------
+    list of pandas Timestamps, starting with head and ending with tail
+    """
+    head, tail = [ts.tz_localize('UTC') if ts.tzinfo is None else ts for ts in (pd.Timestamp(head), pd.Timestamp(tail))]
+    if isinstance(window, int):
+        if resample == 'raw':
+            raise ValueError("A window in rows needs a resample rule, not 'raw'")
+        window = window * to_offset(resample_rule(resample))
+    edges = pd.date_range(start=head, end=tail, freq=window)
+    return [head] + [edge for edge in edges if head < edge < tail] + [tail]
+
+
+def join_series(series):
+    """
+    Join a list of sensor series into a dataframe, with a column per sensor
+    """
+    # workaround for https://github.com/pandas-dev/pandas/issues/12985
+    series = [s for s in series if not s.empty]
+
+    if series:
+        df = pd.concat(series, axis=1)
+    else:
+        df = pd.DataFrame()
+
+    # Add unit as string to each series in the df.  This is not persistent: the attribute unit will get
+    # lost when doing operations with df, but at least it can be checked once.
+    for s in series:
+        try:
+            df[s.name].unit = s.unit
+        except:
+            pass
+
+    return df
+
+
+def stack_series(series):
+    """
+    Stack a list of sensor series into a long dataframe, with a row per value
+
+    Unlike join_series, the sensors do not share an index, so the memory
+    use is proportional to the number of values, also for raw data where
+    every sensor has its own timestamps.
+
+    Returns
+    -------
+    Pandas DataFrame with columns
+        sensor : categorical with the names of the series, in their order
+        timestamp : datetime
+        value : the values, in the dtype of the series
+    """
+    keys = []
+    for s in series:
+        if s.name not in keys:
+            keys.append(s.name)
+    codes = dict((key, code) for code, key in enumerate(keys))
+    series = [s for s in series if not s.empty]
+    tz = series[0].index.tz if series else 'UTC'
+
+    codes = np.repeat(np.array([codes[s.name] for s in series], dtype=np.int32), [len(s) for s in series])
+    timestamps = np.concatenate([s.index.tz_convert('UTC').tz_localize(None).values for s in series]) \
+        if series else np.array([], dtype='datetime64[ns]')
+    values = np.concatenate([s.values for s in series]) if series else np.array([], dtype=float)
+
+    return pd.DataFrame({'sensor': pd.Categorical.from_codes(codes, categories=keys),
+                         'timestamp': pd.DatetimeIndex(timestamps).tz_localize('UTC').tz_convert(tz),
+                         'value': values},
+                        columns=['sensor', 'timestamp', 'value'])
+
+
+def combine_series(series, layout='wide'):
+    """
+    Return join_series(series) for layout 'wide', stack_series(series) for 'long'
+    """
+    if layout == 'wide':
+        return join_series(series)
+    elif layout == 'long':
+        return stack_series(series)
+    raise ValueError("Layout '{}' is not supported, use 'wide' or 'long'".format(layout))
+
@@ -5,8 +5,11 @@ from opengrid.config import Config
 config = Config()
 
 import os
+import re
 import sys
 import json
+import zlib
+import sqlite3
 import jsonpickle
 import datetime as dt
 import pandas as pd
@@ -27,10 +30,16 @@ if sys.version_info.major >= 3:
     from .site import Site
     from .device import Device, Fluksometer
     from .sensor import Sensor, Fluksosensor
+    from .query import Q, AttributeIndex
+    from .fetch import get_series, join_series, combine_series, window_edges, \
+        prefetch_map, resolve_sessions
 else:
     from site import Site
     from device import Device, Fluksometer
     from sensor import Sensor, Fluksosensor
+    from query import Q, AttributeIndex
+    from fetch import get_series, join_series, combine_series, window_edges, \
+        prefetch_map, resolve_sessions
 
 """
 The Houseprint is a Singleton object which contains all metadata for sites, devices and sensors.
@@ -53,6 +62,7 @@ class Houseprint(object):
 
         self.sites = []
         self.timestamp = dt.datetime.utcnow()  # Add a timestamp upon creation
+        self._index = None
 
         if not empty_init:
             if gjson is None:
@@ -143,7 +153,7 @@ class Houseprint(object):
                             k_level=r['K-level'],
                             e_level=r['E-level'],
                             epc_cert=r['EPC certificate'])
-            self.sites.append(new_site)
+            self.add_site(new_site)
 
         print('{} Sites created'.format(len(self.sites)))
 
@@ -175,7 +185,7 @@ class Houseprint(object):
                 raise NotImplementedError('Devices from {} are not supported'.format(r['manufacturer']))
 
             # add new device to parent site
-            site.devices.append(new_device)
+            site.add_device(new_device)
 
         print('{} Devices created'.format(sum([len(site.devices) for site in self.sites])))
 
@@ -226,7 +236,7 @@ class Houseprint(object):
             else:
                 raise NotImplementedError('Sensors from {} are not supported'.format(r['manufacturer']))
 
-            new_sensor.device.sensors.append(new_sensor)
+            new_sensor.device.add_sensor(new_sensor)
 
         print('{} sensors created'.format(sum([len(site.sensors) for site in self.sites])))
 
@@ -241,6 +251,11 @@ class Houseprint(object):
             Returns
             -------
             list of sensors
+
+            Notes
+            -----
+            The list is built from the sites, so unlike query_sensors it
+            follows direct changes to the sensors without reindex().
         """
         res = []
         for site in self.sites:
@@ -288,42 +303,53 @@ class Houseprint(object):
             List of sites satisfying the search criterion or empty list if no
             variable found.
         """
-
-        result = []
-        for site in self.sites:
-            for keyword, value in kwargs.items():
-                if getattr(site, keyword) == value:
-                    continue
-                else:
-                    break
-            else:
-                result.append(site)
-
-        return result
+        return self.query_sites(Q(**kwargs))
 
     def search_sensors(self, **kwargs):
         """
             Parameters
             ----------
             kwargs: any keyword argument, like key=mykey
+                the value has to be a substring of the attribute
 
             Returns
             -------
             List of sensors satisfying the search criterion or empty list if no
             variable found.
         """
+        return self.query_sensors(Q(**dict((keyword + '__contains', value) for keyword, value in kwargs.items())))
 
-        result = []
-        for sensor in self.get_sensors():
-            for keyword, value in kwargs.items():
-                if value in getattr(sensor, keyword):
-                    continue
-                else:
-                    break
-            else:
-                result.append(sensor)
+    def query_sites(self, query):
+        """
+            Parameters
+            ----------
+            query: Q
+
+            Returns
+            -------
+            List of sites matching the query, in the order of self.sites
+        """
+        return self._get_query_index('sites').select(query)
 
-        return result
+    def query_sensors(self, query):
+        """
+            Parameters
+            ----------
+            query: Q
+                Any sensor attribute, plus 'site' and 'device' (their keys) and
+                site__<attribute>, eg. all solar electricity sensors in 9000:
+                Q(type='electricity', system='solar', site__postcode=9000)
+
+            Returns
+            -------
+            List of sensors matching the query, in the order of get_sensors()
+
+            Notes
+            -----
+            The query is answered from an index, call reindex() after
+            changing sensors or their lists directly.
+        """
+        return self._get_query_index('sensors').select(query)
 
     def find_site(self, key):
         """
@@ -335,41 +361,85 @@ class Houseprint(object):
             -------
             Site
         """
-
-        for site in self.sites:
-            if site.key == key:
-                return site
-        return None
+        return self._get_index()['sites'].get(key)
 
     def find_device(self, key):
         """
             Parameters
             ----------
-            key: string
+            key: string, case insensitive
 
             Returns
             -------
             Device
         """
-        for device in self.get_devices():
-            if device.key.lower() == key.lower():
-                return device
-        return None
+        return self._get_index()['devices'].get(_lower(key))
 
     def find_sensor(self, key):
         """
             Parameters
             ----------
-            key: string
+            key: string, case insensitive
 
             Returns
             -------
             Sensor
         """
-        for sensor in self.get_sensors():
-            if sensor.key.lower() == key.lower():
-                return sensor
-        return None
+        return self._get_index()['sensors'].get(_lower(key))
+
+    def reindex(self):
+        """
+        Rebuild the indexes of find_site, find_device, find_sensor and of
+        the queries (search_... and query_...).
+
+        They are kept up to date by add_site, Site.add_device and
+        Device.add_sensor, so this is only needed after changing keys or
+        attributes, or adding sites, devices or sensors to the lists directly.
+        """
+        self._index = dict(sites={}, devices={}, sensors={}, queries={})
+        for site in self.sites:
+            self._index_site(site)
+        return self._index
+
+    def _get_query_index(self, kind):
+        """
+        Return the AttributeIndex of all 'sites' or 'sensors', built on first use
+        """
+        queries = self._get_index()['queries']
+        if kind not in queries:
+            if kind == 'sites':
+                queries[kind] = AttributeIndex(list(self.sites))
+            else:
+                sensors = [sensor for site in self.sites for sensor in site.sensors]
+                queries[kind] = AttributeIndex(sensors, parents=dict(site=_parent_site, device=_parent_device))
+        return queries[kind]
+
+    def _get_index(self):
+        """
+        Return the dicts with the sites (by key), devices and sensors (by
+        lower case key), built on first use (eg. after loading from a file)
+        """
+        index = getattr(self, '_index', None)
+        if index is None:
+            index = self.reindex()
+        return index
+
+    def _index_site(self, site):
+        # the first object with a key is found, as when searching the lists
+        self._get_index()['sites'].setdefault(site.key, site)
+        self._index['queries'].clear()
+        for device in site.devices:
+            self._index_device(device)
+
+    def _index_device(self, device):
+        self._get_index()['devices'].setdefault(_lower(device.key), device)
+        self._index['queries'].clear()
+        for sensor in device.sensors:
+            self._index_sensor(sensor)
+
+    def _index_sensor(self, sensor):
+        self._get_index()['sensors'].setdefault(_lower(sensor.key), sensor)
+        self._index['queries'].clear()
 
     def save(self, filename, pickle_format='jsonpickle'):
         """
@@ -381,17 +451,23 @@ class Houseprint(object):
             Filename, if relative path or just filename, it is appended to the
             current working directory
         pickle_format : str
-            'jsonpickle' or 'pickle'
+            'jsonpickle', 'pickle' or 'compact'
             pickle may be more robust, but jsonpickle should be compatible
-            across python versions
+            across python versions.
+            compact stores tables of sites, devices and sensors (msgpack if
+            it is installed, otherwise json), it is smaller and much faster
+            to load.  Only the attributes of the objects are stored, and
+            they need to be numbers, strings, booleans or None.
 
         """
-        # temporarily delete tmpo session
+        # temporarily delete tmpo session and indexes
         try:
             tmpos_tmp = self._tmpos
             delattr(self, '_tmpos')
         except:
             pass
+        index_tmp = getattr(self, '_index', None)
+        self._index = None
 
         abspath = os.path.join(os.getcwd(), filename)
 
@@ -402,6 +478,9 @@ class Houseprint(object):
         elif pickle_format == 'pickle':
             with open(abspath, 'wb') as f:
                 pickle.dump(self, file=f)
+        elif pickle_format == 'compact':
+            with open(abspath, 'wb') as f:
+                f.write(_dumps_compact(self))
         else:
             raise NotImplementedError("Pickle format '{}' is not supported".format(pickle_format))
 
@@ -412,6 +491,7 @@ class Houseprint(object):
             setattr(self, '_tmpos', tmpos_tmp)
         except:
             pass
+        self._index = index_tmp
 
     def init_tmpo(self, tmpos=None, path_to_tmpo_data=None):
         """
@@ -480,6 +560,11 @@ class Houseprint(object):
             http_errors : 'raise' | 'warn' | 'ignore'
                 default 'warn'
                 define what should be done with TMPO Http-errors
+
+            Notes
+            -----
+            If Sensor.rollup_store is set, it is updated with the new data
+            of each synced sensor.
         """
 
         tmpos = self.get_tmpos()
@@ -498,9 +583,110 @@ class Houseprint(object):
                 else:
                     print('Error for SensorID: ' + sensor.key)
                     raise e
+            if Sensor.rollup_store is not None:
+                Sensor.rollup_store.update(sensor.key, tmpos)
+
+    def update_rollups(self, sensors=None):
+        """
+        Update Sensor.rollup_store with the tmpo data of the Flukso sensors,
+        eg. to build it from a tmpo database that is already synced
+
+        Parameters
+        ----------
+        sensors : list of Fluksosensors, optional
+            default all Flukso sensors
+
+        Returns
+        -------
+        int : number of hours added
+        """
+        if Sensor.rollup_store is None:
+            raise ValueError("Set Sensor.rollup_store to a caching.RollupStore first")
+        if sensors is None:
+            sensors = self.get_fluksosensors()
+        return sum(Sensor.rollup_store.update(sensor.key, sensor.tmpos) for sensor in sensors)
+
+    def warm_unit_conversion_factors(self, resample='min'):
+        """
+        Compute the default unit conversion factors of all sensors, so
+        get_data does not have to parse units.  The factors are memoized
+        per type and unit of the sensors, see misc.conversion_factor.
+
+        Parameters
+        ----------
+        resample : str, default='min'
+        """
+        done = set()
+        for sensor in self.get_sensors():
+            if (sensor.type, sensor.unit) in done:
+                continue
+            done.add((sensor.type, sensor.unit))
+            for diff in (False, True):
+                try:
+                    sensor._unit_conversion_factor(diff=diff, resample=resample)
+                except Exception:
+                    # not all units convert, get_data will raise if it is used
+                    pass
+
+    def data_availability(self, sensors=None):
+        """
+        Return the data available in tmpo for the sensors, read in one pass
+        over the tmpo database instead of a query per sensor
+
+        Parameters
+        ----------
+        sensors : list(Sensor), optional
+            default all sensors in the houseprint
+
+        Returns
+        -------
+        Pandas DataFrame, indexed by sensor key, with columns
+            first : start of the first block
+            last : last timestamp
+            blocks : number of blocks
+            has_data : bool
+        Sensors without tmpo data have NaT as first and last.
+        """
+        if sensors is None:
+            sensors = self.get_sensors()
+        keys = [sensor.key for sensor in sensors]
+
+        con = sqlite3.connect(self.get_tmpos().db)
+        try:
+            blocks = dict((sid, (count, first)) for sid, count, first in con.execute(SQL_BLOCKS))
+            last = {}
+            for sid, ext, blk in con.execute(SQL_LAST_BLOCKS):
+                if sid not in last:
+                    last[sid] = _block_tail(ext, blk)
+        finally:
+            con.close()
+
+        df = pd.DataFrame(index=pd.Index(keys, name='sensor'))
+        df['first'] = pd.to_datetime([blocks.get(key, (0, None))[1] for key in keys], unit='s', utc=True)
+        df['last'] = pd.to_datetime([last.get(key) for key in keys], unit='s', utc=True)
+        df['blocks'] = [blocks.get(key, (0, None))[0] for key in keys]
+        df['has_data'] = df['blocks'] > 0
+        return df
+
+    def last_timestamps(self, sensors=None):
+        """
+        Return the last timestamp of the sensors, like Sensor.last_timestamp,
+        read in one pass over the tmpo database
+
+        Parameters
+        ----------
+        sensors : list(Sensor), optional
+            default all sensors in the houseprint
+
+        Returns
+        -------
+        Pandas Series, indexed by sensor key, NaT for sensors without data
+        """
+        return self.data_availability(sensors)['last']
 
     def get_data(self, sensors=None, sensortype=None, head=None, tail=None, diff='default', resample='min',
-                 unit='default'):
+                 unit='default', workers=None, layout='wide',
+                 dtype=None):
         """
         Return a Pandas Dataframe with joined data for the given sensors
 
@@ -520,33 +706,98 @@ class Houseprint(object):
             Sampling rate, if any.  Use 'raw' if no resampling.
         unit : str , default='default'
             String representation of the target unit, eg m**3/h, kW, ...
+        workers : int, optional
+            Number of threads fetching and resampling the sensors concurrently,
+            each with its own tmpo session.  By default the sensors are fetched
+            one by one.  The result does not depend on the number of workers.
+        layout : 'wide' (default) or 'long'
+            'wide' returns a column per sensor on the union of their
+            timestamps.  'long' returns a row per value, with columns sensor
+            (categorical), timestamp and value, so raw data of many sensors
+            does not become a mostly empty frame.
+        dtype : numpy dtype, optional
+            Type of the values, eg. 'float32' to halve the memory use
         
         """
         if sensors is None:
             sensors = self.get_sensors(sensortype)
-        series = [sensor.get_data(head=head, tail=tail, diff=diff, resample=resample, unit=unit) for sensor in sensors]
+        series = get_series(sensors, workers=workers, head=head, tail=tail, diff=diff, resample=resample, unit=unit,
+                            dtype=dtype)
+        return combine_series(series, layout=layout)
 
-        # workaround for https://github.com/pandas-dev/pandas/issues/12985
-        series = [s for s in series if not s.empty]
+    def get_data_by_day(self, sensors=None, sensortype=None, days=None, window=28, diff='default',
+                        resample='min', unit='default', dtype=None):
+        """
+        Yield (day, Pandas Dataframe) for each day, where the dataframe is
+        identical to get_data(head=day, tail=day + 1 day).
 
-        if series:
-            df = pd.concat(series, axis=1)
-        else:
-            df = pd.DataFrame()
+        Each sensor reads its data in windows of days instead of day by day,
+        so this is a lot faster than calling get_data for each day.
 
-        # Add unit as string to each series in the df.  This is not persistent: the attribute unit will get
-        # lost when doing operations with df, but at least it can be checked once.
-        for s in series:
-            try:
-                df[s.name].unit = s.unit
-            except:
-                pass
+        Parameters
+        ----------
+        sensors : list of Sensor objects
+            If None, use sensortype to make a selection
+        sensortype : string (optional)
+            gas, water, electricity. If None, and Sensors = None,
+            all available sensors in the houseprint are fetched
+        days : list or DatetimeIndex with sorted pandas Timestamps
+        window : int, default=28
+            Number of days read at once.  Peak memory use is proportional to
+            window times the number of sensors.
+        diff, resample, unit, dtype : see get_data
+        """
+        if sensors is None:
+            sensors = self.get_sensors(sensortype)
+        generators = [sensor.get_data_by_day(days=days, window=window, diff=diff, resample=resample, unit=unit,
+                                             dtype=dtype)
+                      for sensor in sensors]
+        for day_series in zip(*generators):
+            day = day_series[0][0]
+            yield day, join_series([s for _, s in day_series])
+
+    def get_data_windows(self, sensors=None, sensortype=None, head=None, tail=None, window='D', diff='default',
+                         resample='min', unit='default', layout='wide', dtype=None):
+        """
+        Yield (start, Pandas Dataframe) for consecutive time windows from head
+        to tail, so a long pull over many sensors runs in bounded memory.
 
-        return df
+        Each window includes its start and excludes its end, so the
+        concatenated dataframes are identical to get_data(head=head, tail=tail):
+        interpolation and differentiation are correct across the windows.  A
+        head off the resample grid gives the first window a leading bin
+        before head, as in get_data.
+
+        Parameters
+        ----------
+        sensors : list of Sensor objects
+            If None, use sensortype to make a selection
+        sensortype : string (optional)
+            gas, water, electricity. If None, and Sensors = None,
+            all available sensors in the houseprint are fetched
+        head : timestamp
+        tail : timestamp, optional
+            default now
+        window : str or int, default='D'
+            Pandas frequency of the windows, eg. 'D', '7D', 'W', 'MS', or a
+            number of rows of the resampled data
+        diff, resample, unit, layout, dtype : see get_data
+        """
+        if head is None:
+            raise ValueError("get_data_windows needs a head")
+        if tail is None:
+            tail = pd.Timestamp.utcnow()
+        if sensors is None:
+            sensors = self.get_sensors(sensortype)
+        edges = window_edges(head, tail, window, resample=resample)
+        generators = [sensor.get_data_windows(edges, diff=diff, resample=resample, unit=unit, dtype=dtype)
+                      for sensor in sensors]
+        for start in edges[:-1]:
+            yield start, combine_series([next(generator)[1] for generator in generators], layout=layout)
 
     def get_data_dynamic(self, sensors=None, sensortype=None, head=None,
                          tail=None, diff='default', resample='min',
-                         unit='default'):
+                         unit='default', prefetch=None):
         """
         Yield Pandas Series for the given sensors
 
@@ -569,6 +820,10 @@ class Houseprint(object):
         unit : str
             default='default'
             String representation of the target unit, eg m**3/h, kW, ...
+        prefetch : int, optional
+            Number of sensors fetched ahead in a background thread, while the
+            caller processes the current one.  If None, each sensor is
+            fetched when the caller asks for it.
 
         Yields
         ------
@@ -577,13 +832,26 @@ class Houseprint(object):
         if sensors is None:
             sensors = self.get_sensors(sensortype)
 
-        for sensor in sensors:
-            ts = sensor.get_data(head=head, tail=tail, diff=diff,
-                                  resample=resample, unit=unit)
-            if ts.empty:
-                continue
-            else:
-                yield ts
+        def get_data(sensor):
+            return sensor.get_data(head=head, tail=tail, diff=diff,
+                                   resample=resample, unit=unit)
+
+        if prefetch:
+            sensors = list(sensors)
+            resolve_sessions(sensors)
+            series = prefetch_map(get_data, sensors, depth=prefetch)
+        else:
+            series = (get_data(sensor) for sensor in sensors)
+
+        try:
+            for ts in series:
+                if ts.empty:
+                    continue
+                else:
+                    yield ts
+        finally:
+            # stops the prefetching thread when the caller stops early
+            series.close()
 
     def add_site(self, site):
         """
@@ -593,6 +861,176 @@ class Houseprint(object):
         """
         site.hp = self
         self.sites.append(site)
+        self._index_site(site)
+
+
+# number of blocks and start of the first block of all sensors in tmpo
+SQL_BLOCKS = """
+    SELECT sid, COUNT(*), MIN(bid)
+    FROM tmpo
+    GROUP BY sid"""
+
+# the last block of all sensors in tmpo, as in tmpo.SQL_TMPO_LAST_DATA: the first row of each sid
+SQL_LAST_BLOCKS = """
+    SELECT tmpo.sid, ext, data
+    FROM tmpo
+    JOIN (SELECT sid, MAX(created) AS created FROM tmpo GROUP BY sid) AS last
+    ON tmpo.sid = last.sid AND tmpo.created = last.created
+    ORDER BY tmpo.sid, lvl DESC"""
+
+
+def _block_tail(ext, blk):
+    """
+    Return the epoch of the last point in a tmpo block, from its header
+    """
+    if ext != 'gz':
+        return None
+    jblk = zlib.decompress(blk, zlib.MAX_WBITS | 16).decode('utf-8')
+    header = json.loads(re.match(r'^\{"h":(\{.+?\})', jblk).group(1))
+    return header['tail'][0]
+
+
+def _parent_device(sensor):
+    return sensor.device
+
+
+def _parent_site(sensor):
+    if sensor.site is not None:
+        return sensor.site
+    if sensor.device is not None:
+        return sensor.device.site
+    return None
+
+
+def _lower(key):
+    """
+    Return the key in lower case, for case insensitive lookups
+    """
+    return key.lower() if hasattr(key, 'lower') else key
+
+
+# header of houseprints saved with pickle_format='compact', followed by the encoding
+COMPACT_MAGIC = b'opengrid-houseprint-compact:'
+COMPACT_VERSION = 1
+
+# classes that can be restored from the compact format
+_COMPACT_CLASSES = dict((cls.__name__, cls) for cls in [Site, Device, Fluksometer, Sensor, Fluksosensor])
+
+# attributes that refer to other objects, stored as row numbers or left out
+_COMPACT_REFERENCES = {'hp', 'site', 'device', 'devices', 'sensors', '_tmpos'}
+
+
+def _table(objects, references):
+    """
+    Return a columnar table {column: [values]} with the class and attributes
+    of the objects, and the given references (row numbers in other tables)
+    """
+    columns = []
+    for obj in objects:
+        columns += [k for k in obj.__dict__ if k not in _COMPACT_REFERENCES and k not in columns]
+    table = dict((column, [obj.__dict__.get(column) for obj in objects]) for column in columns)
+    table['_class'] = [obj.__class__.__name__ for obj in objects]
+    table.update(references)
+    return table
+
+
+def _dumps_compact(hp):
+    """
+    Return the bytes of a houseprint in the compact format
+    """
+    # the parents are the sites and devices holding the objects in their lists
+    sites = hp.sites
+    devices, device_sites = [], []
+    for i, site in enumerate(sites):
+        devices += site.devices
+        device_sites += [i] * len(site.devices)
+    sensors, sensor_devices = [], []
+    for i, device in enumerate(devices):
+        sensors += device.sensors
+        sensor_devices += [i] * len(device.sensors)
+    site_rows = dict((id(site), i) for i, site in enumerate(sites))
+
+    attributes = dict((k, v) for k, v in hp.__dict__.items() if k not in ('sites', '_tmpos', '_index'))
+    if isinstance(attributes.get('timestamp'), dt.datetime):
+        attributes['timestamp'] = attributes['timestamp'].isoformat()
+
+    data = dict(version=COMPACT_VERSION,
+                houseprint=attributes,
+                sites=_table(sites, {}),
+                devices=_table(devices, {'_site': device_sites}),
+                sensors=_table(sensors, {'_device': sensor_devices,
+                                         '_site': [site_rows.get(id(sensor.site)) for sensor in sensors]}))
+    try:
+        import msgpack
+    except ImportError:
+        return COMPACT_MAGIC + b'json\n' + json.dumps(data, separators=(',', ':')).encode('utf-8')
+    return COMPACT_MAGIC + b'msgpack\n' + msgpack.packb(data, use_bin_type=True)
+
+
+def _rows(table, references):
+    """
+    Yield (object, {reference: row number}) for each row of a columnar table
+    """
+    columns = [column for column in table if not column.startswith('_')]
+    classes = table['_class']
+    for i in range(len(classes)):
+        obj = _COMPACT_CLASSES[classes[i]].__new__(_COMPACT_CLASSES[classes[i]])
+        obj.__dict__ = dict((column, table[column][i]) for column in columns)
+        yield obj, dict((reference, table[reference][i]) for reference in references)
+
+
+def _loads_compact(data):
+    """
+    Return a houseprint from the bytes of the compact format
+    """
+    header, data = data.split(b'\n', 1)
+    encoding = header[len(COMPACT_MAGIC):].decode('ascii')
+    if encoding == 'json':
+        data = json.loads(data.decode('utf-8'))
+    elif encoding == 'msgpack':
+        try:
+            import msgpack
+        except ImportError:
+            raise ImportError("This houseprint was saved with msgpack, install it with `pip install msgpack`")
+        data = msgpack.unpackb(data, raw=False)
+    else:
+        raise NotImplementedError("Houseprint encoding '{}' is not supported".format(encoding))
+    if data['version'] > COMPACT_VERSION:
+        raise NotImplementedError("Houseprint format version {} is not supported, update opengrid".format(
+            data['version']))
+
+    hp = Houseprint.__new__(Houseprint)
+    hp.__dict__ = dict(data['houseprint'])
+    if hp.__dict__.get('timestamp') is not None:
+        hp.timestamp = pd.Timestamp(hp.timestamp).to_pydatetime()
+    hp.sites = []
+    hp._index = None
+
+    sites = []
+    for site, refs in _rows(data['sites'], []):
+        site.hp = hp
+        site.devices = []
+        site._tmpos = None
+        sites.append(site)
+    hp.sites = sites
+
+    devices = []
+    for device, refs in _rows(data['devices'], ['_site']):
+        device.site = sites[refs['_site']]
+        device.sensors = []
+        if isinstance(device, Fluksometer):
+            device._tmpos = None
+        device.site.devices.append(device)
+        devices.append(device)
+
+    for sensor, refs in _rows(data['sensors'], ['_device', '_site']):
+        sensor.device = devices[refs['_device']]
+        sensor.site = None if refs['_site'] is None else sites[refs['_site']]
+        if isinstance(sensor, Fluksosensor):
+            sensor._tmpos = None
+        sensor.device.sensors.append(sensor)
+
+    return hp
 
 
 def load_houseprint_from_file(filename, pickle_format='jsonpickle'):
@@ -603,11 +1041,21 @@ def load_houseprint_from_file(filename, pickle_format='jsonpickle'):
     ----------
     filename : str
     pickle_format : str
-        'jsonpickle' or 'pickle'
+        'jsonpickle', 'pickle' or 'compact'
         pickle may be more robust, but jsonpickle should be compatible
-        across python versions
+        across python versions.
+        Files saved in the compact format are recognized whatever this
+        argument.
     """
-    if pickle_format == 'jsonpickle':
+    with open(filename, 'rb') as f:
+        compact = f.read(len(COMPACT_MAGIC)) == COMPACT_MAGIC
+
+    if compact:
+        with open(filename, 'rb') as f:
+            hp = _loads_compact(f.read())
+    elif pickle_format == 'compact':
+        raise ValueError("{} is not a houseprint in the compact format".format(filename))
+    elif pickle_format == 'jsonpickle':
         with open(filename, 'r') as f:
             hp = jsonpickle.decode(f.read())
     elif pickle_format == 'pickle':
@@ -616,4 +1064,5 @@ def load_houseprint_from_file(filename, pickle_format='jsonpickle'):
     else:
         raise NotImplementedError("Pickle format '{}' is not supported".format(pickle_format))
 
+    hp.warm_unit_conversion_factors()
     return hp
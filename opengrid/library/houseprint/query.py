@@ -0,0 +1,155 @@
+"""
+Queries on the attributes of sites and sensors of a Houseprint.
+
+A query is built with Q objects, and answered by an AttributeIndex: for each
+attribute used in a query, the index holds the positions of the objects by
+value, so a query is a couple of set operations instead of a scan over all
+objects.
+"""
+
+
+class Q(object):
+    """
+    A query on the attributes of sites or sensors
+
+    Q(field=value, ...) matches the objects for which all fields equal their
+    value.  Append a lookup to the field name for other comparisons:
+        field__contains=value : value is a substring of the field
+        field__in=[value, ...] : the field equals one of the values
+
+    Combine queries with & (and), | (or) and ~ (not).
+
+    For sensors, the fields 'site' and 'device' are the keys of the parent
+    site and device, and site__<attribute> is an attribute of the parent
+    site, eg. all solar electricity sensors in postcode 9000:
+
+        Q(type='electricity', system='solar', site__postcode=9000)
+    """
+
+    LOOKUPS = ('exact', 'contains', 'in')
+
+    def __init__(self, **kwargs):
+        self.op = 'leaf'
+        self.children = ()
+        self.conditions = []
+        for name, value in sorted(kwargs.items()):
+            field, _, lookup = name.rpartition('__')
+            if lookup not in self.LOOKUPS:
+                field, lookup = name, 'exact'
+            self.conditions.append((field, lookup, value))
+
+    @classmethod
+    def _combine(cls, op, *children):
+        q = cls()
+        q.op = op
+        q.children = children
+        return q
+
+    def __and__(self, other):
+        return self._combine('and', self, other)
+
+    def __or__(self, other):
+        return self._combine('or', self, other)
+
+    def __invert__(self):
+        return self._combine('not', self)
+
+    def __repr__(self):
+        if self.op == 'leaf':
+            return 'Q({})'.format(', '.join('{}__{}={!r}'.format(*c) for c in self.conditions))
+        if self.op == 'not':
+            return '~{!r}'.format(self.children[0])
+        return '({!r} {} {!r})'.format(self.children[0], '&' if self.op == 'and' else '|', self.children[1])
+
+    def evaluate(self, index):
+        """
+        Return the set of positions of the objects in the index matching this query
+        """
+        if self.op == 'and':
+            return self.children[0].evaluate(index) & self.children[1].evaluate(index)
+        if self.op == 'or':
+            return self.children[0].evaluate(index) | self.children[1].evaluate(index)
+        if self.op == 'not':
+            return index.all - self.children[0].evaluate(index)
+
+        res = index.all
+        for field, lookup, value in self.conditions:
+            res = res & index.lookup(field, lookup, value)
+        return res
+
+
+def _contains(field_value, value):
+    try:
+        return value in field_value
+    except TypeError:
+        # eg. None or a number
+        return False
+
+
+class AttributeIndex(object):
+    """
+    Inverted index on the attributes of a list of objects (sites or sensors)
+
+    The positions of the objects by value of a field are collected on first
+    use of that field.  The index does not follow changes to the objects.
+    """
+
+    def __init__(self, objects, parents=None):
+        """
+        Parameters
+        ----------
+        objects : list
+        parents : dict, optional
+            {name: function returning the parent object (or None)}.  The field
+            name is then the key of the parent, name__attribute an attribute
+            of the parent.
+        """
+        self.objects = objects
+        self.parents = parents or {}
+        self.all = frozenset(range(len(objects)))
+        self._fields = {}
+
+    def _getter(self, field):
+        name, _, attribute = field.partition('__')
+        if name in self.parents:
+            parent = self.parents[name]
+            attribute = attribute or 'key'
+
+            def get(obj):
+                p = parent(obj)
+                return None if p is None else getattr(p, attribute)
+            return get
+        return lambda obj: getattr(obj, field)
+
+    def values(self, field):
+        """
+        Return a dict {value: frozenset with the positions of the objects}
+        """
+        res = self._fields.get(field)
+        if res is None:
+            get = self._getter(field)
+            res = {}
+            for position, obj in enumerate(self.objects):
+                res.setdefault(get(obj), set()).add(position)
+            res = dict((value, frozenset(positions)) for value, positions in res.items())
+            self._fields[field] = res
+        return res
+
+    def lookup(self, field, lookup, value):
+        """
+        Return the set of positions of the objects for which the field matches the value
+        """
+        values = self.values(field)
+        if lookup == 'exact':
+            return values.get(value, frozenset())
+        if lookup == 'in':
+            return frozenset().union(*[values.get(v, frozenset()) for v in value])
+        if lookup == 'contains':
+            return frozenset().union(*[positions for v, positions in values.items() if _contains(v, value)])
+        raise ValueError("Lookup '{}' is not supported, use one of {}".format(lookup, Q.LOOKUPS))
+
+    def select(self, query):
+        """
+        Return the objects matching the query, in their original order
+        """
+        return [self.objects[position] for position in sorted(query.evaluate(self))]
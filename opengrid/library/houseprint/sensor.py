@@ -10,11 +10,25 @@ This class contains all metadata concerning the function and type of the sensor
 
 from opengrid.library import misc
 from opengrid import ureg
+import numpy as np
 import pandas as pd
+from pandas.tseries.frequencies import to_offset
 import tmpo, sqlite3
+import sys
+
+# compatibility with py3
+if sys.version_info.major >= 3:
+    from . import fetch
+else:
+    import fetch
 
 
 class Sensor(object):
+    # set to a caching.ResultCache to reuse the results of get_data
+    result_cache = None
+    # set to a caching.RollupStore to serve hourly and daily get_data from it
+    rollup_store = None
+
     def __init__(self, key=None, device=None, site=None, type=None,
                  description=None, system=None, quantity=None, unit=None,
                  direction=None, tariff=None, cumulative=None):
@@ -59,6 +73,49 @@ class Sensor(object):
 
         raise NotImplementedError("Subclass must implement abstract method")
 
+    def get_data_by_day(self, days, window=28, **kwargs):
+        """
+        Yield (day, Pandas Series) with the data of each day, identical to
+        get_data(head=day, tail=day + 1 day)
+
+        Parameters
+        ----------
+        days : list or DatetimeIndex with sorted pandas Timestamps
+        window : int, default=28
+            Number of days fetched at once, if the sensor supports it
+        kwargs : passed to get_data
+
+        Notes
+        -----
+        This generic version fetches the data day by day, subclasses can
+        do this more efficiently.
+        """
+        for day in days:
+            yield day, self.get_data(head=day, tail=day + pd.Timedelta(days=1), **kwargs)
+
+    def get_data_windows(self, edges, **kwargs):
+        """
+        Yield (start, Pandas Series) with the data of each window between
+        consecutive edges, start included and end excluded (the last end
+        is included)
+
+        Parameters
+        ----------
+        edges : list of pandas Timestamps
+        kwargs : passed to get_data
+
+        Notes
+        -----
+        This generic version fetches each window separately, so it does not
+        interpolate or differentiate across the edges.  Subclasses can do this
+        correctly.
+        """
+        for start, end, last in fetch.windows(edges):
+            data = self.get_data(head=start, tail=end, **kwargs)
+            if not last and not data.empty:
+                data = data[data.index < end]
+            yield start, data
+
     def _get_default_unit(self, diff=True, resample='min'):
         """
         Return a string representation of the default unit for the requested operation
@@ -131,8 +188,19 @@ class Sensor(object):
         -------
         cf : float
             Multiplication factor for the original data to the target unit
+
+        Notes
+        -----
+        The factor is memoized by type, unit, diff, resample and target, see
+        misc.conversion_factor.
         """
+        key = ('sensor', self.type, self.unit, diff, resample, target)
+        return misc.conversion_factor(key, lambda: self._compute_unit_conversion_factor(diff, resample, target))
 
+    def _compute_unit_conversion_factor(self, diff, resample, target):
+        """
+        Return the conversion factor, see _unit_conversion_factor
+        """
         # get the target
         if target == 'default':
             target = self._get_default_unit(diff=diff, resample=resample)
@@ -239,9 +307,9 @@ class Fluksosensor(Sensor):
     @property
     def tmpos(self):
         if self._tmpos is not None:
-            return self._tmpos
+            return fetch.session(self._tmpos)
         elif self.device is not None:
-            return self.device.tmpos
+            return fetch.session(self.device.tmpos)
         else:
             raise AttributeError('TMPO session not defined')
 
@@ -258,7 +326,8 @@ class Fluksosensor(Sensor):
         tmpos = self.site.hp.get_tmpos()
         return len(tmpos.list(self.key)[0]) != 0
 
-    def get_data(self, head=None, tail=None, diff='default', resample='min', unit='default', tz='UTC'):
+    def get_data(self, head=None, tail=None, diff='default', resample='min', unit='default', tz='UTC',
+                 dtype=None):
         """
         Connect to tmpo and fetch a data series
 
@@ -281,52 +350,195 @@ class Fluksosensor(Sensor):
             String representation of the target unit, eg m**3/h, kW, ...
         tz : str, default='UTC'
             Specify the timezone for the index of the returned dataframe
+        dtype : numpy dtype, optional
+            Type of the returned values, eg. 'float32' to halve the memory
+            use.  The computations are done in float64.
 
         Returns
         -------
         Pandas Series with additional attribute 'unit' set to
         the string representation of the unit of the data.
+
+        Notes
+        -----
+        If Sensor.result_cache is set, a result is reused until new data of
+        the sensor arrives in tmpo for the interval.
+
+        If Sensor.rollup_store is set, a resample to whole hours or days in
+        UTC is served from it when it covers head and tail, see
+        caching.RollupStore.get.
         """
 
         if head is None:
             head = 0
         if tail is None:
             tail = 2147483647  # tmpo epochs max
+        # tmpo only takes int epochs and pandas Timestamps
+        head, tail = _epochs(head), _epochs(tail)
+
+        if Sensor.result_cache is None:
+            return self._get_data(head=head, tail=tail, diff=diff, resample=resample, unit=unit, tz=tz, dtype=dtype)
+
+        return Sensor.result_cache.get(
+            key=(self.key, head, tail, diff, resample, unit, tz, str(dtype)), tail=tail,
+            watermark=lambda: self.tmpos.last_timestamp(sid=self.key, epoch=True),
+            compute=lambda: self._get_data(head=head, tail=tail, diff=diff, resample=resample, unit=unit, tz=tz,
+                                           dtype=dtype))
+
+    def _get_data(self, head, tail, diff, resample, unit, tz, dtype=None):
+        """
+        Same as get_data, without the result cache
+        """
+        if Sensor.rollup_store is not None and resample != 'raw' and tz == 'UTC':
+            if diff == 'default':
+                diff = self.cumulative
+            data = Sensor.rollup_store.get(self.key, self.tmpos, head=_epochs(head), tail=_epochs(tail),
+                                           rule=fetch.resample_rule(resample), diff=diff)
+            if data is not None:
+                return self._process_data(data, diff=diff, resample=resample, unit=unit, tz=tz, dtype=dtype,
+                                          resampled=True)
 
         data = self.tmpos.series(sid=self.key, head=head, tail=tail)
+        return self._process_data(data, diff=diff, resample=resample, unit=unit, tz=tz, dtype=dtype)
 
-        if data.dropna().empty:
-            # Return an empty dataframe with correct name
-            return pd.Series(name=self.key)
+    def get_data_by_day(self, days, window=28, diff='default', resample='min', unit='default', tz='UTC',
+                        dtype=None):
+        """
+        Yield (day, Pandas Series) with the data of each day, identical to
+        get_data(head=day, tail=day + 1 day)
 
-        data = data.tz_convert(tz)
+        The raw tmpo series is read once for each window of days and split
+        into days in memory, which saves a tmpo query per day.
 
-        if resample != 'raw':
+        Parameters
+        ----------
+        days : list or DatetimeIndex with sorted pandas Timestamps
+        window : int, default=28
+            Number of days read from tmpo at once.  The memory use is
+            proportional to it.
+        diff, resample, unit, tz, dtype : see get_data
+        """
+        days = list(days)
+        for i in range(0, len(days), window):
+            chunk = days[i:i + window]
+            raw = self.tmpos.series(sid=self.key, head=chunk[0], tail=chunk[-1] + pd.Timedelta(days=1))
+
+            for day in chunk:
+                if raw.empty:
+                    data = raw
+                else:
+                    # tmpo includes both head and tail, in whole seconds
+                    head = pd.Timestamp(day.value // 10**9, unit='s', tz='UTC')
+                    tail = head + pd.Timedelta(days=1)
+                    data = raw[(raw.index >= head) & (raw.index <= tail)]
+                yield day, self._process_data(data, diff=diff, resample=resample, unit=unit, tz=tz, dtype=dtype)
+
+    def get_data_windows(self, edges, diff='default', resample='min', unit='default', tz='UTC', dtype=None):
+        """
+        Yield (start, Pandas Series) with the data of each window between
+        consecutive edges, start included and end excluded (the last end
+        is included)
+
+        The concatenated windows are identical to get_data(head=edges[0],
+        tail=edges[-1]): the raw points around each edge are carried to the
+        next window, and the first raw point after a window is read ahead, so
+        interpolation and differentiation are correct across the edges.  As
+        in get_data, a head off the resample grid gives the first window a
+        leading bin before it, eg. 03:00 for a head at 03:13:25.  Only
+        one window of raw data is held in memory (plus empty windows read
+        ahead over a gap).
 
-            if resample == 'hour':
-                rule = 'H'
-            elif resample == 'day':
-                rule = 'D'
+        Parameters
+        ----------
+        edges : list of pandas Timestamps
+        diff, resample, unit, tz, dtype : see get_data
+        """
+        windows = list(fetch.windows(edges))
+        chunks = (self._get_raw_window(start, end, last) for start, end, last in windows)
+        ahead = []
+        carry = pd.Series()
+
+        for start, end, last in windows:
+            current = ahead.pop(0) if ahead else next(chunks)
+            parts = [carry, current]
+
+            if resample != 'raw':
+                # the first point after the window, to interpolate up to its end
+                i = 0
+                while not last:
+                    if i == len(ahead):
+                        try:
+                            ahead.append(next(chunks))
+                        except StopIteration:
+                            break
+                    if not ahead[i].empty:
+                        parts.append(ahead[i].iloc[:1])
+                        break
+                    i += 1
+
+            parts = [part for part in parts if not part.empty]
+            if parts:
+                data = self._process_data(pd.concat(parts), diff=diff, resample=resample, unit=unit, tz=tz,
+                                          dtype=dtype)
+                if not data.empty:
+                    # like get_data, the first window keeps the bin holding an unaligned head
+                    mask = (data.index >= start) if start > windows[0][0] else np.ones(len(data), dtype=bool)
+                    mask &= (data.index <= end) if last else (data.index < end)
+                    unit_ = data.unit
+                    data = data[mask]
+                    data.unit = unit_
             else:
-                rule = resample
+                data = pd.Series(name=self.key, dtype=dtype)
+            yield start, data
+
+            # keep the raw points from the last one at least two periods before the next window,
+            # for the interpolation and differentiation of its first value
+            parts = [part for part in [carry, current] if not part.empty]
+            if parts and resample != 'raw':
+                carry = pd.concat(parts)
+                anchor = end - 2 * to_offset(fetch.resample_rule(resample))
+                before = carry.index[carry.index <= anchor]
+                if len(before):
+                    carry = carry[carry.index >= before[-1]]
+
+    def _get_raw_window(self, start, end, last):
+        """
+        Return the raw tmpo series from start to end, end excluded unless last
+        """
+        raw = self.tmpos.series(sid=self.key, head=start, tail=end)
+        if not last and not raw.empty:
+            raw = raw[raw.index < end]
+        return raw
 
-            # interpolate to requested frequency
-            newindex = data.resample(rule).first().index
-            data = data.reindex(data.index.union(newindex))
-            data = data.interpolate(method='time')
-            data = data.reindex(newindex)
+    def _process_data(self, data, diff, resample, unit, tz, dtype=None, resampled=False):
+        """
+        Resample, differentiate and convert a raw tmpo series, see get_data
 
+        If resampled, data is already resampled and differentiated (by the
+        rollup store) and only converted.
+        """
+        # the raw data decides, resampled data can be all nan
+        if data.empty if resampled else data.dropna().empty:
+            # Return an empty dataframe with correct name
+            return pd.Series(name=self.key, dtype=dtype)
+
+        if not resampled:
+            # resampled data is in UTC, the only tz served by the rollup store
+            data = data.tz_convert(tz)
+
+        if resample != 'raw':
             if diff == 'default':
                 diff = self.cumulative
-
-            if diff:
-                data = data.diff()
+            if not resampled:
+                data = _resample(data, fetch.resample_rule(resample), diff=diff)
 
         # unit conversion
         if unit == 'default':
             unit = self._get_default_unit(diff=diff, resample=resample)
         ucf = self._unit_conversion_factor(diff=diff, resample=resample, target=unit)
         data *= ucf
+        if dtype is not None:
+            data = data.astype(dtype)
         data.unit = unit
 
         return data
@@ -349,3 +561,69 @@ class Fluksosensor(Sensor):
         """
         tmpos = self.site.hp.get_tmpos()
         return tmpos.last_timestamp(sid=self.key, epoch=epoch)
+
+
+def _epochs(ts):
+    """
+    Return a head or tail of get_data in epochs, like tmpo does (naive timestamps are UTC)
+
+    Numbers are epochs in seconds, like misc.parse_date takes them.
+    """
+    if isinstance(ts, (int, float, np.integer, np.floating)):
+        return int(ts)
+    return int(pd.Timestamp(ts).value // 10**9)
+
+
+DAY = 86400 * 10**9  # in ns
+
+
+def _resample(data, rule, diff=False):
+    """
+    Interpolate a raw series to the rule, and differentiate it if diff
+
+    For a fixed frequency that divides a day, and a UTC index, this works on
+    the int64 epochs with numpy.  Otherwise, and for an unsorted index, it
+    falls back on pandas.  Both give the same series.
+    """
+    try:
+        step = to_offset(rule).nanos
+    except (AttributeError, ValueError):
+        step = None
+    if step is None or DAY % step or str(data.index.tz) != 'UTC' \
+            or not (data.index.is_monotonic_increasing and data.index.is_unique):
+        return _resample_pandas(data, rule, diff=diff)
+
+    epochs = data.index.values.astype('datetime64[ns]').astype(np.int64)
+    values = data.values.astype(float)
+
+    # the bins of resample(rule) from the first to the last raw point
+    first = epochs[0] - epochs[0] % step
+    newindex = np.arange(first, epochs[-1] + 1, step)
+
+    valid = ~np.isnan(values)
+    epochs, values = epochs[valid], values[valid]
+    res = np.interp(newindex, epochs, values)
+    # no extrapolation before the first value
+    res[newindex < epochs[0]] = np.nan
+    if diff:
+        res = np.diff(res, prepend=np.nan)
+
+    index = pd.date_range(start=pd.Timestamp(first, tz='UTC'), periods=len(newindex), freq=rule)
+    if hasattr(index, 'as_unit'):
+        # pandas >= 2 keeps the resolution of the raw index
+        index = index.as_unit(data.index.unit)
+    return pd.Series(res, index=index, name=data.name)
+
+
+def _resample_pandas(data, rule, diff=False):
+    """
+    Same as _resample, with pandas resample, reindex and interpolate
+    """
+    newindex = data.resample(rule).first().index
+    data = data.reindex(data.index.union(newindex))
+    data = data.interpolate(method='time')
+    data = data.reindex(newindex)
+
+    if diff:
+        data = data.diff()
+    return data
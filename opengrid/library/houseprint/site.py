@@ -1,6 +1,12 @@
 __author__ = 'Jan Pecinovsky'
 
-import pandas as pd
+import sys
+
+# compatibility with py3
+if sys.version_info.major >= 3:
+    from .fetch import get_series, combine_series
+else:
+    from fetch import get_series, combine_series
 
 """
 A Site is a physical entity (a house, appartment, school, or other building).
@@ -70,7 +76,9 @@ class Site(object):
         """
         return [sensor for sensor in self.sensors if sensor.type == sensortype or sensortype is None]
 
-    def get_data(self, sensortype=None, head=None, tail=None, diff='default', resample='min', unit='default'):
+    def get_data(self, sensortype=None, head=None, tail=None, diff='default', resample='min', unit='default',
+                 workers=None, layout='wide',
+                 dtype=None):
         """
         Return a Pandas Dataframe with the joined data for all sensors in this device
 
@@ -90,31 +98,20 @@ class Site(object):
             Sampling rate, if any.  Use 'raw' if no resampling.
         unit : str , default='default'
             String representation of the target unit, eg m**3/h, kW, ...
+        workers : int, optional
+            Number of threads fetching the sensors concurrently, default one by one
+        layout : 'wide' (default) or 'long'
+        dtype : numpy dtype, optional
+            See Houseprint.get_data
 
         Returns
         -------
         Pandas DataFrame
         """
         sensors = self.get_sensors(sensortype)
-        series = [sensor.get_data(head=head, tail=tail, diff=diff, resample=resample, unit=unit) for sensor in sensors]
-
-        # workaround for https://github.com/pandas-dev/pandas/issues/12985
-        series = [s for s in series if not s.empty]
-
-        if series:
-            df = pd.concat(series, axis=1)
-        else:
-            df = pd.DataFrame()
-
-        # Add unit as string to each series in the df.  This is not persistent: the attribute unit will get
-        # lost when doing operations with df, but at least it can be checked once.
-        for s in series:
-            try:
-                df[s.name].unit = s.unit
-            except:
-                pass
-
-        return df
+        series = get_series(sensors, workers=workers, head=head, tail=tail, diff=diff, resample=resample, unit=unit,
+                            dtype=dtype)
+        return combine_series(series, layout=layout)
 
     def add_device(self, device):
         """
@@ -124,4 +121,6 @@ class Site(object):
         """
 
         device.site = self
-        self.devices.append(device)
\ No newline at end of file
+        self.devices.append(device)
+        if self.hp is not None:
+            self.hp._index_device(device)
\ No newline at end of file
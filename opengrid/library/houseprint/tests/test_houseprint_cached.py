@@ -8,11 +8,60 @@ Created on Mon Dec 30 02:37:25 2013
 """
 
 import os, sys
+import gzip
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
 import inspect
 import numpy as np
+import pandas as pd
+import tmpo
+
+from opengrid.library.houseprint import houseprint, fetch, sensor
+from opengrid.library import caching
+
+class RawSession(object):
+    """
+    Stands in for a tmpo session holding a single raw series
+    """
+    def __init__(self, raw):
+        self.raw = raw
+
+    def series(self, sid, head=None, tail=None):
+        # tmpo includes head and tail, in whole seconds
+        head, tail = [pd.Timestamp(sensor._epochs(ts), unit='s', tz='UTC') for ts in (head, tail)]
+        return self.raw[(self.raw.index >= head) & (self.raw.index <= tail)]
+
+    def last_timestamp(self, sid, epoch=False):
+        if self.raw.empty:
+            return None
+        return self.raw.index[-1].value // 10**9 if epoch else self.raw.index[-1]
+
+
+def _houseprint_with(*raws, **kwargs):
+    """
+    Return a houseprint with one site and a Fluksometer and Fluksosensor per
+    raw series, keyed by its name
+
+    A key instead of a series gives a sensor on the tmpo session of the
+    houseprint.  kwargs (type, unit) are passed to the sensors.
+    """
+    kwargs.setdefault('type', 'electricity')
+    kwargs.setdefault('unit', '')
+    hp = houseprint.Houseprint(empty_init=True)
+    site = houseprint.Site(key=1)
+    hp.add_site(site)
+    for raw in raws:
+        key = raw if isinstance(raw, str) else raw.name
+        device = houseprint.Fluksometer(key='FL' + key, tmpos=None if isinstance(raw, str) else RawSession(raw))
+        site.add_device(device)
+        device.add_sensor(houseprint.Fluksosensor(key=key, token='t', device=device, system='', description='',
+                                                  quantity='', direction='', tariff='', cumulative=None, **kwargs))
+    return hp
 
-from opengrid.library.houseprint import houseprint
 
 class HouseprintTest(unittest.TestCase):
     """
@@ -97,6 +146,71 @@ class HouseprintTest(unittest.TestCase):
         self.assertEqual(['s2'], [x.key for x in sensors])
 
 
+    def test_query_sensors(self):
+        """Querying sensors with and, or, not and attributes of the site"""
+
+        Q = houseprint.Q
+        self.assertEqual(['s1', 's2'], [x.key for x in self.hp.query_sensors(Q(system='grid'))])
+        self.assertEqual(['s6', 's12', 's13'], [x.key for x in self.hp.query_sensors(Q(type__in=['water']))])
+
+        sensors = self.hp.query_sensors(Q(system='grid') | Q(type='water'))
+        self.assertEqual(['s1', 's2', 's6', 's12', 's13'], [x.key for x in sensors])
+
+        sensors = self.hp.query_sensors(Q(type='electricity', direction__contains='Imp') & ~Q(key='s1'))
+        self.assertEqual(['s2'], [x.key for x in sensors])
+
+        site = self.hp.sites[4]
+        sensors = self.hp.query_sensors(Q(site__postcode=site.postcode, site=site.key))
+        self.assertEqual([x.key for x in site.sensors], [x.key for x in sensors])
+
+    def test_find(self):
+        """Finding sites, devices and sensors by key"""
+
+        self.assertEqual(4, self.hp.find_site(4).key)
+        self.assertIsNone(self.hp.find_site(99))
+        self.assertEqual('FL03001003a', self.hp.find_device('fl03001003A').key)
+        self.assertEqual('s12', self.hp.find_sensor('S12').key)
+        self.assertIsNone(self.hp.find_sensor('nosensor'))
+
+    def test_find_after_adding(self):
+        """Sites, devices and sensors added later can be found"""
+
+        hp = houseprint.Houseprint(empty_init=True)
+        site = houseprint.Site(key=1)
+        device = houseprint.Fluksometer(key='FL1')
+        device.add_sensor(houseprint.Sensor(key='s1'))
+        site.add_device(device)
+        hp.add_site(site)
+        device.add_sensor(houseprint.Sensor(key='s2'))
+
+        self.assertIs(site, hp.find_site(1))
+        self.assertIs(device, hp.find_device('fl1'))
+        self.assertEqual(['s1', 's2'], [hp.find_sensor(key).key for key in ['s1', 'S2']])
+
+    def test_get_sensors_after_direct_changes(self):
+        """get_sensors follows direct changes to the sensors, the queries after reindex()"""
+
+        hp = houseprint.Houseprint(empty_init=True)
+        site = houseprint.Site(key=1)
+        hp.add_site(site)
+        device = houseprint.Fluksometer(key='FL1')
+        site.add_device(device)
+        device.add_sensor(houseprint.Sensor(key='s1', type='electricity'))
+        self.assertEqual(['s1'], [x.key for x in hp.get_sensors('electricity')])
+        self.assertEqual(['s1'], [x.key for x in hp.query_sensors(houseprint.Q(type='electricity'))])
+
+        s2 = houseprint.Sensor(key='s2', type='gas', device=device)
+        device.sensors.append(s2)
+        hp.get_sensors()[0].type = 'water'
+        self.assertEqual(['s1', 's2'], [x.key for x in hp.get_sensors()])
+        self.assertEqual([], hp.get_sensors('electricity'))
+        self.assertEqual(['s1'], [x.key for x in hp.get_sensors('water')])
+        self.assertEqual(['s2'], [x.key for x in hp.get_sensors('gas')])
+
+        self.assertEqual([], hp.query_sensors(houseprint.Q(type='gas')))
+        hp.reindex()
+        self.assertEqual(['s2'], [x.key for x in hp.query_sensors(houseprint.Q(type='gas'))])
+
     def test_save_and_load(self):
         """Save a HP and load it back"""
         
@@ -121,6 +235,289 @@ class HouseprintTest(unittest.TestCase):
         # remove temp.hp file
         os.remove('temp.hp')
 
+    def test_save_and_load_compact(self):
+        """Save a HP in the compact format and load it back"""
+
+        hp = houseprint.Houseprint(empty_init=True)
+        site = houseprint.Site(key=1, postcode=9000, inhabitants=3)
+        hp.add_site(site)
+        device = houseprint.Fluksometer(key='FL1', mastertoken='mt')
+        site.add_device(device)
+        for key, type in [('s1', 'electricity'), ('s2', 'water')]:
+            device.add_sensor(houseprint.Fluksosensor(key=key, token='t', device=device, type=type, system='',
+                                                      description='', quantity='', unit='', direction='',
+                                                      tariff='', cumulative=None))
+        hp.save('temp.hp', pickle_format='compact')
+        # the format is recognized, also with the default pickle_format
+        hp2 = houseprint.load_houseprint_from_file('temp.hp')
+        os.remove('temp.hp')
+
+        self.assertEqual(hp.timestamp, hp2.timestamp)
+        site2 = hp2.find_site(1)
+        self.assertIs(hp2, site2.hp)
+        self.assertEqual((9000, 3), (site2.postcode, site2.inhabitants))
+        self.assertEqual('mt', site2.devices[0].mastertoken)
+        s2 = hp2.find_sensor('s2')
+        self.assertIs(site2.devices[0], s2.device)
+        self.assertIs(site2, s2.site)
+        self.assertEqual(hp.find_sensor('s2').__dict__.keys(), s2.__dict__.keys())
+        for x in ["key", "type", "unit", "cumulative", "token"]:
+            self.assertEqual(hp.find_sensor('s2').__dict__[x], s2.__dict__[x])
+
+    def test_get_data_workers(self):
+        """Fetching with a thread pool gives the same frame, with a tmpo session per thread"""
+
+        folder = tempfile.mkdtemp()
+        tmpos = tmpo.Session(folder)
+        sessions = {}
+
+        class ThreadSensor(houseprint.Sensor):
+            def get_data(self, head=None, tail=None, **kwargs):
+                sessions[self.key] = fetch.session(tmpos)
+                # the first sensors finish last
+                time.sleep(0.002 * (10 - len(self.key)))
+                return pd.Series(np.arange(3.) * len(self.key), name=self.key,
+                                 index=pd.date_range(head, periods=3, freq='min', tz='UTC'))
+
+        hp = houseprint.Houseprint(empty_init=True)
+        site = houseprint.Site(key=1)
+        hp.add_site(site)
+        device = houseprint.Device(key='d')
+        site.add_device(device)
+        keys = ['s' * i for i in range(1, 9)]
+        for key in keys:
+            device.add_sensor(ThreadSensor(key=key, type='electricity'))
+
+        head = pd.Timestamp('20160101', tz='UTC')
+        df = hp.get_data(head=head)
+        self.assertTrue(all(s is tmpos for s in sessions.values()))
+        sessions.clear()
+        df_workers = hp.get_data(head=head, workers=4)
+        shutil.rmtree(folder)
+
+        self.assertListEqual(keys, list(df_workers.columns))
+        pd.testing.assert_frame_equal(df, df_workers)
+        pd.testing.assert_frame_equal(df, site.get_data(head=head, workers=4))
+        self.assertTrue(all(s is not tmpos and s.db == tmpos.db for s in sessions.values()))
+
+    def test_get_data_dynamic_prefetch(self):
+        """Prefetching yields the same series, reads ahead at most depth sensors and stops when closed"""
+
+        fetched = []
+        # set when the background thread starts on the fourth sensor
+        fourth = threading.Event()
+
+        class SlowSensor(houseprint.Sensor):
+            def get_data(self, head=None, tail=None, **kwargs):
+                fetched.append(self.key)
+                if len(fetched) == 4:
+                    fourth.set()
+                if self.key == 'bad':
+                    raise ValueError(self.key)
+                return pd.Series(np.arange(3.) * len(self.key), name=self.key,
+                                 index=pd.date_range(head, periods=3, freq='min', tz='UTC'))
+
+        keys = ['s' * i for i in range(1, 9)]
+        sensors = [SlowSensor(key=key, type='electricity') for key in keys]
+        head = pd.Timestamp('20160101', tz='UTC')
+        threads = threading.active_count()
+
+        expected = list(self.hp.get_data_dynamic(sensors=sensors, head=head))
+        del fetched[:]
+        res = list(self.hp.get_data_dynamic(sensors=sensors, head=head, prefetch=2))
+        self.assertEqual(len(expected), len(res))
+        for ts, ts_prefetch in zip(expected, res):
+            pd.testing.assert_series_equal(ts, ts_prefetch)
+
+        del fetched[:]
+        fourth.clear()
+        series = self.hp.get_data_dynamic(sensors=sensors, head=head, prefetch=2)
+        next(series)
+        # one series at the caller, two in the queue and one waiting to be queued
+        self.assertTrue(fourth.wait(timeout=10))
+        series.close()
+        self.assertEqual(threads, threading.active_count())
+        self.assertEqual(4, len(fetched))
+
+        sensors.insert(2, SlowSensor(key='bad', type='electricity'))
+        series = self.hp.get_data_dynamic(sensors=sensors, head=head, prefetch=2)
+        self.assertEqual(2, len([next(series), next(series)]))
+        self.assertRaises(ValueError, next, series)
+        self.assertEqual(threads, threading.active_count())
+
+    def test_get_data_windows(self):
+        """The windows are identical to a single get_data, also over a gap across an edge, for sparse data
+        and for a head off the resample grid"""
+
+        rng = np.random.RandomState(1)
+        index = pd.Timestamp('20160101', tz='UTC') + pd.to_timedelta(np.arange(0, 3 * 86400, 67), unit='s')
+        index = index[(index < pd.Timestamp('20160102 22:00', tz='UTC')) |
+                      (index > pd.Timestamp('20160103 03:00', tz='UTC'))]
+        raw = pd.Series(np.cumsum(rng.uniform(0, 5, len(index))), index=index, name='s')
+
+        # sparse: a raw point every 83 minutes
+        sparse = raw.iloc[::75].rename('sparse')
+        hp = _houseprint_with(raw, sparse)
+
+        tail = pd.Timestamp('20160103 20:00', tz='UTC')
+        # the second head is off the hourly grid, get_data starts with the bin at 03:00
+        for head in [pd.Timestamp('20160101 05:00', tz='UTC'), pd.Timestamp('20160101 03:13:25', tz='UTC')]:
+            for resample in ['min', 'h']:
+                df = hp.get_data(head=head, tail=tail, resample=resample)
+                for window in ['D', '6h', 97]:
+                    windows = list(hp.get_data_windows(head=head, tail=tail, window=window, resample=resample))
+                    self.assertEqual(head, windows[0][0])
+                    pd.testing.assert_frame_equal(df, pd.concat([w for _, w in windows if not w.empty]),
+                                                  check_freq=False)
+        self.assertEqual(pd.Timestamp('20160101 03:00', tz='UTC'), df.index[0])
+
+    def test_resample(self):
+        """The numpy resampling gives the same series as the pandas one"""
+
+        rng = np.random.RandomState(0)
+        index = pd.Timestamp('20160301', tz='UTC') + pd.to_timedelta(np.sort(rng.choice(3 * 86400, 2000, replace=False)),
+                                                                     unit='s')
+        values = np.cumsum(rng.uniform(0, 5, len(index)))
+        values[[0, 5, 1000]] = np.nan
+        data = pd.Series(values, index=index, name='s')
+        for rule in ['min', '15min', 'D']:
+            for diff in [False, True]:
+                pd.testing.assert_series_equal(sensor._resample_pandas(data, rule, diff=diff),
+                                               sensor._resample(data, rule, diff=diff))
+
+    def test_data_availability(self):
+        """The bulk data availability agrees with tmpo per sensor"""
+
+        folder = tempfile.mkdtemp()
+        tmpos = tmpo.Session(folder)
+        con = sqlite3.connect(tmpos.db)
+        con.execute(tmpo.SQL_SENSOR_TABLE)
+        con.execute(tmpo.SQL_TMPO_TABLE)
+        for sid, bid, tail in [('s1', 1451606400, 1451607000), ('s1', 1451610496, 1451611000),
+                               ('s2', 1451606400, 1451606460)]:
+            blk = '{"h":{"head":[%d,0],"tail":[%d,1]},"t":[0,%d],"v":[0,1]}' % (bid, tail, tail - bid)
+            con.execute(tmpo.SQL_TMPO_INS, (sid, 0, 12, bid, 'gz', float(tail), gzip.compress(blk.encode('utf-8'))))
+        con.commit()
+        con.close()
+
+        hp = _houseprint_with('s1', 's2', 's3')
+        hp.init_tmpo(tmpos=tmpos)
+
+        df = hp.data_availability()
+        last = hp.last_timestamps()
+        shutil.rmtree(folder)
+
+        self.assertListEqual([2, 1, 0], df['blocks'].tolist())
+        self.assertListEqual([True, True, False], df['has_data'].tolist())
+        self.assertEqual(pd.Timestamp(1451611000, unit='s', tz='UTC'), last['s1'])
+        self.assertEqual(pd.Timestamp(1451606400, unit='s', tz='UTC'), df.loc['s2', 'first'])
+        self.assertTrue(pd.isnull(last['s3']))
+
+    def test_get_data_long(self):
+        """The long layout has a row per raw value, with the same values as the wide one"""
+
+        raws = [pd.Series(np.arange(10. * i), name=key,
+                          index=pd.date_range('20160101', periods=10 * i, freq='{}s'.format(7 + i), tz='UTC'))
+                for i, key in enumerate(['s1', 's2', 's3'])]
+        hp = _houseprint_with(*raws, type='temperature', unit='degC')
+
+        head, tail = pd.Timestamp('20160101', tz='UTC'), pd.Timestamp('20160102', tz='UTC')
+        wide = hp.get_data(head=head, tail=tail, diff=False, resample='raw')
+        long = hp.get_data(head=head, tail=tail, diff=False, resample='raw', layout='long')
+
+        self.assertListEqual(['sensor', 'timestamp', 'value'], list(long.columns))
+        self.assertEqual(30, len(long))
+        self.assertListEqual(['s1', 's2', 's3'], list(long['sensor'].cat.categories))
+        for key in ['s2', 's3']:
+            rows = long[long['sensor'] == key]
+            np.testing.assert_array_equal(wide[key].dropna().values, rows['value'].values)
+            self.assertListEqual(list(wide[key].dropna().index), list(rows['timestamp']))
+        self.assertRaises(ValueError, hp.get_data, head=head, tail=tail, layout='diagonal')
+
+        narrow = hp.get_data(head=head, tail=tail, diff=False, resample='raw', layout='long', dtype='float32')
+        self.assertEqual(np.float32, narrow['value'].dtype)
+        np.testing.assert_array_equal(long['value'].values, narrow['value'].values)
+        self.assertTrue((hp.get_data(head=head, tail=tail, diff=False, resample='min', dtype='float32').dtypes
+                         == np.float32).all())
+
+    def test_get_data_epochs(self):
+        """Any number is taken as an epoch in seconds for head and tail, also with the result cache"""
+        index = pd.date_range('20160101', periods=100, freq='min', tz='UTC')
+        s = _houseprint_with(pd.Series(np.arange(100.), index=index, name='s'), type='temperature',
+                             unit='degC').find_sensor('s')
+        head, tail = pd.Timestamp('20160101 00:10', tz='UTC'), pd.Timestamp('20160101 00:20', tz='UTC')
+        expected = s.get_data(head=head, tail=tail)
+        self.assertEqual(11, len(expected))
+
+        folder = tempfile.mkdtemp()
+        try:
+            for result_cache in [None, caching.ResultCache(folder=folder)]:
+                sensor.Sensor.result_cache = result_cache
+                for epoch in [int, float, np.int64, np.float64]:
+                    pd.testing.assert_series_equal(expected, s.get_data(head=epoch(head.value // 10**9),
+                                                                        tail=epoch(tail.value // 10**9)))
+        finally:
+            sensor.Sensor.result_cache = None
+            shutil.rmtree(folder)
+
+    def test_rollup_store(self):
+        """Hourly and daily get_data from the rollup store is identical to the one from the raw data"""
+
+        rng = np.random.RandomState(2)
+        epochs = 1451606400 + np.cumsum(rng.randint(5, 400, 6000))
+        # a gap of a few hours
+        epochs = epochs[(epochs < 1451606400 + 5 * 86400 + 1234) | (epochs > 1451606400 + 5 * 86400 + 20000)]
+        raw = pd.Series(np.cumsum(rng.uniform(0, 10, len(epochs))), index=pd.to_datetime(epochs, unit='s', utc=True),
+                        name='s')
+        hp = _houseprint_with(raw[raw.index < pd.Timestamp('20160110', tz='UTC')], unit='Wh')
+        s = hp.find_sensor('s')
+        tmpos = s.device.tmpos
+
+        def get_data(**kwargs):
+            sensor.Sensor.rollup_store = store
+            res = s.get_data(**kwargs)
+            sensor.Sensor.rollup_store = None
+            expected = s.get_data(**kwargs)
+            pd.testing.assert_series_equal(expected, res)
+            self.assertEqual(getattr(expected, 'unit', None), getattr(res, 'unit', None))
+
+        folder = tempfile.mkdtemp()
+        store = caching.RollupStore(folder)
+        try:
+            self.assertRaises(ValueError, hp.update_rollups)
+            sensor.Sensor.rollup_store = store
+            self.assertGreater(hp.update_rollups(), 0)
+            self.assertEqual(0, hp.update_rollups())
+            sensor.Sensor.rollup_store = None
+
+            days = [None, pd.Timestamp('20151231', tz='UTC'), pd.Timestamp('20160103', tz='UTC'),
+                    pd.Timestamp('20160106 03:00', tz='UTC'), pd.Timestamp('20160109', tz='UTC')]
+            queries = list(zip(days[:-1], days[1:])) + [(None, None), (days[2], None), (days[3], days[1])]
+            for resample, diff in [('h', True), ('h', False), ('3h', False), ('day', True), ('day', False)]:
+                for head, tail in queries:
+                    get_data(head=head, tail=tail, resample=resample, diff=diff)
+            self.assertEqual(0, store.misses)
+
+            # not covered: head within an hour, or new data in tmpo
+            get_data(head=pd.Timestamp('20160103 12:34', tz='UTC'), resample='h')
+            tmpos.raw = raw
+            get_data(head=days[3], resample='day')
+            self.assertEqual(2, store.misses)
+
+            sensor.Sensor.rollup_store = store
+            self.assertGreater(hp.update_rollups(), 0)
+            get_data(head=days[3], resample='h')
+            self.assertEqual(2, store.misses)
+
+            # identical to a store built at once
+            rebuilt = caching.RollupStore(os.path.join(folder, 'rebuilt'))
+            rebuilt.update('s', tmpos)
+            for name, values in store._load('s').items():
+                np.testing.assert_array_equal(values, rebuilt._load('s')[name])
+        finally:
+            sensor.Sensor.rollup_store = None
+            shutil.rmtree(folder)
+
     def test_cumulative_setting(self):
         device = self.hp.get_devices()[0]
         sensor = houseprint.Fluksosensor(key = 'key',
@@ -107,7 +107,44 @@ def unit_conversion_factor(source, target):
     if source == target:
         return 1
     else:
-        return 1 * ureg(source).to(target).magnitude
+        return conversion_factor(('units', source, target), lambda: 1 * ureg(source).to(target).magnitude)
+
+
+# memoized conversion factors, see conversion_factor
+_conversion_factors = {}
+
+
+def conversion_factor(key, compute):
+    """
+    Return the conversion factor for key, computed only on first use.
+
+    Parsing units with pint takes milliseconds, so the factors are kept
+    for the lifetime of the process.  Call clear_conversion_factors after
+    changing the unit registry.
+
+    Parameters
+    ----------
+    key : hashable
+        Everything the factor depends on
+    compute : callable
+        Returns the factor, called once for each key
+
+    Returns
+    -------
+    cf : float
+    """
+    try:
+        return _conversion_factors[key]
+    except KeyError:
+        cf = _conversion_factors[key] = compute()
+        return cf
+
+
+def clear_conversion_factors():
+    """
+    Forget all memoized conversion factors
+    """
+    _conversion_factors.clear()
 
 
 def dayset(start, end):
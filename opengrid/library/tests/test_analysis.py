@@ -51,6 +51,13 @@ class AnalysisTest(unittest.TestCase):
         self.assertTrue((anls.result.index==dayindex).all())
         self.assertTrue((anls.result['A'] == pd.Series(data=[0,24,48,72], index=dayindex)).all())
 
+    def test_DailyAgg_dtype(self):
+        index = pd.DatetimeIndex(start='20160101 00:51:15', freq='h', periods=80)
+        df = pd.DataFrame(index=index, data={'A': np.arange(0, 80, 1), 'B': np.zeros(80)})
+
+        anls = analysis.DailyAgg(df, agg='min', dtype='float32')
+        self.assertTrue((anls.result.dtypes == np.float32).all())
+
     def test_DailyAgg_analysis_with_timelimits(self):
         "Check results when limiting the hours for the analysis"
         index = pd.DatetimeIndex(start='20160101 00:51:15', freq='h', periods=80)
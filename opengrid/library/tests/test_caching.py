@@ -19,19 +19,53 @@ import numpy as np
 import pdb
 import pandas as pd
 import pytz
+import shutil
+import tempfile
+import json
 
 test_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 os.chdir(test_dir)
 # add the path to opengrid to sys.path
 sys.path.insert(1, os.path.join(test_dir, os.pardir, os.pardir, os.pardir))
-from opengrid.library import caching
+from opengrid.library import caching, analysis
 from opengrid.library.houseprint import Sensor
 
 # Note: there is a opengrid.cfg in the test_dir which is loaded here!!
 from opengrid import config
 cfg = config.Config()
 
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+class DyingSensor(Sensor):
+    """
+    Sensor with two days of hourly data, or that kills the process fetching it
+    """
+    def get_data(self, head=None, tail=None, **kwargs):
+        if self.key == 'dying':
+            os._exit(1)
+        index = pd.date_range('20160101', periods=48, freq='h', tz='UTC')
+        return pd.Series(np.arange(48.), index=index, name=self.key)
+
+
+def update_days(folder, first_day):
+    """Update a cached sensor day by day, used to test concurrent processes"""
+    ch = caching.Cache('elec_temp', folder=folder)
+    for day in pd.date_range(start=first_day, freq='4D', periods=3, tz='Europe/Brussels'):
+        index = pd.date_range(start=day, freq='D', periods=2)
+        ch.update(pd.DataFrame(index=index, data=index.day, columns=['testsensor1']))
+
 class CacheTest(unittest.TestCase):
+
+    def tearDown(self):
+        # writing creates a manifest and a lock next to the cached data
+        for filename in ['elec_temp.manifest.json', 'elec_temp.lock']:
+            path = os.path.join(test_dir, cfg.get('data', 'folder'), 'cache_day', filename)
+            if os.path.exists(path):
+                os.remove(path)
     
     def test_init(self):
         """Check if correct folder is used"""
@@ -250,6 +284,412 @@ class CacheTest(unittest.TestCase):
             os.remove(expected_path2)
 
 
+    def test_journal_torn_record(self):
+        """A record torn by a crash is dropped, also when other records are appended after it"""
+        folder = tempfile.mkdtemp()
+        try:
+            ch = caching.Cache('elec_temp', folder=folder, journal=True)
+            testsensor = Sensor(key='testsensor')
+            index = pd.date_range(start='20160101', freq='D', periods=3, tz='Europe/Brussels')
+            ch.update(pd.DataFrame(index=index, data=[0, 1, 2], columns=['testsensor']))
+            size = os.path.getsize(ch._journal.path)
+            ch.update(pd.DataFrame(index=index[1:] + pd.Timedelta(days=2), data=[3, 4], columns=['testsensor']))
+            full = os.path.getsize(ch._journal.path)
+
+            for cut in range(size + 1, full, 7):
+                with open(ch._journal.path, 'r+b') as f:
+                    f.truncate(cut)
+                self.assertEqual(1, len(ch._journal.records()))
+                ch.update(pd.DataFrame(index=index[1:] + pd.Timedelta(days=4), data=[5, 6], columns=['testsensor']))
+                self.assertListEqual([0, 1, 2, 5, 6], ch.get([testsensor])['testsensor'].tolist())
+                with open(ch._journal.path, 'r+b') as f:
+                    f.truncate(size)
+
+            # a damaged byte in a complete record
+            ch.update(pd.DataFrame(index=index[1:] + pd.Timedelta(days=2), data=[3, 4], columns=['testsensor']))
+            with open(ch._journal.path, 'r+b') as f:
+                f.seek(size + 40)
+                byte = f.read(1)
+                f.seek(size + 40)
+                f.write(bytes(bytearray([ord(byte) ^ 0xff])))
+            ch.update(pd.DataFrame(index=index[1:] + pd.Timedelta(days=4), data=[5, 6], columns=['testsensor']))
+            self.assertListEqual([0, 1, 2, 5, 6], ch.get([testsensor])['testsensor'].tolist())
+            self.assertTrue(ch.compact())
+            self.assertFalse(ch._journal.exists())
+            self.assertListEqual([0, 1, 2, 5, 6], ch.get([testsensor])['testsensor'].tolist())
+        finally:
+            shutil.rmtree(folder)
+
+    def test_update_journal(self):
+        """Updates go to the journal, are visible when reading and are folded in by compact"""
+        folder = tempfile.mkdtemp()
+        try:
+            ch = caching.Cache('elec_temp', folder=folder, journal=True)
+            testsensor = Sensor(key='testsensor')
+
+            index = pd.date_range(start='20160101', freq='D', periods=3, tz='Europe/Brussels')
+            ch.update(pd.DataFrame(index=index, data=[0, 1, 2], columns=['testsensor']))
+            index = pd.date_range(start='20160103', freq='D', periods=3, tz='Europe/Brussels')
+            ch.update(pd.DataFrame(index=index, data=[100, 200, 300], columns=['testsensor']))
+            self.assertListEqual(sorted(os.listdir(folder)), ['elec_temp.journal', 'elec_temp.lock',
+                                                           'elec_temp.manifest.json'])
+
+            df_res = ch.get([testsensor])
+            self.assertListEqual(df_res['testsensor'].tolist(), [0, 1, 100, 200, 300])
+
+            self.assertTrue(ch.compact())
+            self.assertListEqual(sorted(os.listdir(folder)), ['elec_temp.lock', 'elec_temp.manifest.json',
+                                                           'elec_temp_testsensor.pkl'])
+            df_res = ch.get([testsensor])
+            self.assertListEqual(df_res['testsensor'].tolist(), [0, 1, 100, 200, 300])
+        finally:
+            shutil.rmtree(folder)
+
+    def test_manifest(self):
+        """The manifest tracks first day, last day and rows of each sensor, also for the journal"""
+        folder = tempfile.mkdtemp()
+        try:
+            ch = caching.Cache('elec_temp', folder=folder, journal=True)
+            testsensor1 = Sensor(key='testsensor1')
+            testsensor2 = Sensor(key='testsensor2')
+            self.assertListEqual(ch.sensors(), [])
+            self.assertIsNone(ch.last_day(testsensor1))
+
+            index = pd.date_range(start='20160101', freq='D', periods=3, tz='Europe/Brussels')
+            ch._write(pd.DataFrame(index=index, data=dict(testsensor1=[0, 1, 2], testsensor2=[0, 1, np.nan])))
+            index = pd.date_range(start='20160103', freq='D', periods=3, tz='Europe/Brussels')
+            ch.update(pd.DataFrame(index=index, data=[100, 200, 300], columns=['testsensor1']))
+
+            # the saved entries are kept, the queries do not load the manifest again
+            entries = ch._entries
+            self.assertListEqual(ch.sensors(), ['testsensor1', 'testsensor2'])
+            self.assertIs(entries, ch._entries)
+            with open(os.path.join(folder, 'elec_temp.manifest.json')) as f:
+                self.assertEqual(json.load(f), entries)
+            self.assertEqual(ch.last_day(testsensor1), pd.Timestamp('20160105', tz='Europe/Brussels'))
+            coverage = ch.coverage([testsensor2, testsensor1])
+            self.assertListEqual(coverage.index.tolist(), ['testsensor2', 'testsensor1'])
+            self.assertListEqual(coverage['rows'].tolist(), [2, 5])
+            self.assertEqual(coverage.loc['testsensor2', 'first_day'], pd.Timestamp('20160101', tz='Europe/Brussels'))
+
+            # without manifest, it is rebuilt from the cached data
+            ch.compact()
+            os.remove(os.path.join(folder, 'elec_temp.manifest.json'))
+            ch = caching.Cache('elec_temp', folder=folder)
+            self.assertListEqual(ch.coverage()['rows'].tolist(), [5, 2])
+        finally:
+            shutil.rmtree(folder)
+
+    def test_lru(self):
+        """Repeated reads come from the lru until the files change"""
+        folder = tempfile.mkdtemp()
+        try:
+            ch = caching.Cache('elec_temp', folder=folder)
+            testsensor = Sensor(key='testsensor')
+            index = pd.date_range(start='20160101', freq='D', periods=3, tz='Europe/Brussels')
+            ch._write_single(pd.DataFrame(index=index, data=[0, 1, 2], columns=['testsensor']))
+            caching.Cache.lru = caching.FrameLRU()
+
+            ch.get([testsensor])
+            ch.get([testsensor])
+            self.assertEqual(caching.Cache.lru.misses, 1)
+            self.assertEqual(caching.Cache.lru.hits, 1)
+
+            # a write in this process drops the entry
+            ch._write_single(pd.DataFrame(index=index, data=[3, 4, 5], columns=['testsensor']))
+            self.assertEqual(len(caching.Cache.lru), 0)
+            self.assertListEqual(ch.get([testsensor])['testsensor'].tolist(), [3, 4, 5])
+
+            # a write by another process changes the signature of the file
+            other = caching.PickleStorage(folder, 'elec_temp')
+            index = pd.date_range(start='20160101', freq='D', periods=4, tz='Europe/Brussels')
+            other.write(pd.DataFrame(index=index, data=[6, 7, 8, 9], columns=['testsensor']))
+            self.assertListEqual(ch.get([testsensor])['testsensor'].tolist(), [6, 7, 8, 9])
+            self.assertEqual(caching.Cache.lru.misses, 3)
+        finally:
+            caching.Cache.lru = None
+            shutil.rmtree(folder)
+
+    def test_mmap_write_and_get(self):
+        """The mmap storage returns dataframes backed by the memory-mapped matrix"""
+        folder = tempfile.mkdtemp()
+        try:
+            ch = caching.Cache('elec_temp', folder=folder, storage='mmap')
+            index = pd.date_range(start='20160101', freq='D', periods=40, tz='Europe/Brussels')
+            df = pd.DataFrame(index=index, data=dict(testsensor1=np.arange(40.), testsensor2=np.arange(40.) * 2))
+            ch._write(df)
+
+            testsensor1 = Sensor(key='testsensor1')
+            testsensor2 = Sensor(key='testsensor2')
+            df_res = ch.get([testsensor1, testsensor2], start='20160110', end='20160119')
+            self.assertEqual(len(df_res), 10)
+            self.assertEqual(df_res.index[0], pd.Timestamp('20160110', tz='Europe/Brussels'))
+            self.assertEqual(df_res.loc[df_res.index[0], 'testsensor2'], 18)
+
+            values = df_res.values
+            while not isinstance(values, np.memmap):
+                self.assertIsNotNone(values.base, "Returned dataframe is not backed by the memory-map")
+                values = values.base
+
+            # only daily values at midnight can be stored
+            index = pd.date_range(start='20160101 12:00', freq='D', periods=3, tz='Europe/Brussels')
+            self.assertRaises(ValueError, ch._write_single, pd.Series(index=index, data=[0, 1, 2], name='testsensor3'))
+        finally:
+            shutil.rmtree(folder)
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    def test_parquet_write_and_get(self):
+        """Write multiple sensors to yearly parquet files and read them back aligned"""
+        folder = tempfile.mkdtemp()
+        try:
+            ch = caching.Cache('elec_temp', folder=folder, storage='parquet')
+            index = pd.date_range(start='20161230', freq='D', periods=4, tz='UTC')
+            df = pd.DataFrame(index=index, data=dict(testsensor1=[0., 1, 2, 3], testsensor2=[np.nan, 1, 2, 3]))
+            ch._write(df)
+            self.assertListEqual(sorted(os.listdir(os.path.join(folder, 'elec_temp'))),
+                                 ['2016.parquet', '2017.parquet'])
+
+            testsensor1 = Sensor(key='testsensor1')
+            testsensor2 = Sensor(key='testsensor2')
+            df_res = ch.get([testsensor2, testsensor1])
+            self.assertListEqual(df_res.columns.tolist(), ['testsensor2', 'testsensor1'])
+            self.assertEqual(len(df_res), 4)
+            self.assertTrue(np.isnan(df_res.iloc[0, 0]))
+            self.assertEqual(df_res.iloc[3, 1], 3)
+
+            # overwriting a sensor removes its data from all partitions
+            ch._write_single(df['testsensor1'].iloc[2:])
+            self.assertEqual(len(ch._load('testsensor1')), 2)
+            self.assertEqual(len(ch._load('testsensor2')), 3)
+        finally:
+            shutil.rmtree(folder)
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    def test_parquet_update_rewrites_changed_partitions_only(self):
+        """An update within one year leaves the partitions of the other years alone"""
+        folder = tempfile.mkdtemp()
+        try:
+            ch = caching.Cache('elec_temp', folder=folder, storage='parquet')
+            index = pd.date_range(start='20161229', freq='D', periods=4, tz='UTC')
+            ch._write(pd.DataFrame(index=index, data=dict(testsensor1=[0., 1, 2, 3], testsensor2=[5., 6, 7, 8])))
+            path2016 = os.path.join(folder, 'elec_temp', '2016.parquet')
+            os.utime(path2016, (0, 0))
+
+            index = pd.date_range(start='20170101', freq='D', periods=3, tz='UTC')
+            ch.update(pd.DataFrame(index=index, data=dict(testsensor1=[30., 40, 50])))
+            self.assertEqual(0, os.path.getmtime(path2016))
+            df_res = ch.get([Sensor(key='testsensor1'), Sensor(key='testsensor2')])
+            self.assertListEqual(df_res['testsensor1'].tolist(), [0, 1, 2, 30, 40, 50])
+            self.assertListEqual(df_res['testsensor2'].dropna().tolist(), [5, 6, 7, 8])
+
+            index = pd.date_range(start='20161230', freq='D', periods=2, tz='UTC')
+            ch.update(pd.DataFrame(index=index, data=dict(testsensor1=[10., 20])))
+            self.assertNotEqual(0, os.path.getmtime(path2016))
+            self.assertListEqual(ch.get([Sensor(key='testsensor1')])['testsensor1'].tolist(), [0, 10, 20, 30, 40, 50])
+        finally:
+            shutil.rmtree(folder)
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    def test_parquet_get_reads_only_partitions_in_range(self):
+        """Partitions outside of start and end are not read"""
+        folder = tempfile.mkdtemp()
+        try:
+            ch = caching.Cache('elec_temp', folder=folder, storage='parquet')
+            index = pd.date_range(start='20150601', end='20170601', freq='D', tz='Europe/Brussels')
+            ch._write(pd.DataFrame(index=index, data=np.arange(len(index)), columns=['testsensor']))
+
+            # corrupt the partition of 2015, reading it would fail
+            with open(os.path.join(folder, 'elec_temp', '2015.parquet'), 'wb') as f:
+                f.write(b'corrupt')
+
+            df = ch.get([Sensor(key='testsensor')], start='20160701', end='20170105')
+            self.assertEqual(df.index[0], pd.Timestamp('20160701', tz='Europe/Brussels'))
+            self.assertEqual(df.index[-1], pd.Timestamp('20170105', tz='Europe/Brussels'))
+        finally:
+            shutil.rmtree(folder)
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    def test_parquet_migrates_pickles(self):
+        """Pickles are moved into the parquet storage the first time they are read"""
+        folder = tempfile.mkdtemp()
+        try:
+            index = pd.date_range(start='20160101', freq='D', periods=3, tz='UTC')
+            df = pd.DataFrame(index=index, data=[0., 1, 2], columns=['testsensor'])
+            caching.Cache('elec_temp', folder=folder)._write_single(df)
+            pickle_path = os.path.join(folder, 'elec_temp_testsensor.pkl')
+            self.assertTrue(os.path.exists(pickle_path))
+
+            ch = caching.Cache('elec_temp', folder=folder, storage='parquet')
+            df_res = ch._load('testsensor')
+            self.assertListEqual(df_res['testsensor'].tolist(), [0, 1, 2])
+            self.assertFalse(os.path.exists(pickle_path))
+            self.assertTrue(os.path.exists(os.path.join(folder, 'elec_temp', '2016.parquet')))
+        finally:
+            shutil.rmtree(folder)
+
+    def test_stats(self):
+        """Cache.stats counts the calls, rows and files of each operation"""
+        folder = tempfile.mkdtemp()
+        try:
+            caching.Cache.stats = caching.CacheStats()
+            ch = caching.Cache('elec_temp', folder=folder)
+            index = pd.date_range(start='20160101', freq='D', periods=3, tz='Europe/Brussels')
+            ch.update(pd.DataFrame(index=index, data=dict(testsensor1=[0, 1, 2], testsensor2=[0, 1, 2])))
+            ch.get([Sensor(key='testsensor1')])
+
+            stats = caching.Cache.stats.to_dict()['variables']['elec_temp']
+            self.assertEqual(stats['update']['calls'], 1)
+            self.assertEqual(stats['write']['files'], 2)
+            self.assertEqual(stats['write']['bytes'], sum(os.path.getsize(os.path.join(folder, f))
+                                                         for f in os.listdir(folder) if f.endswith('.pkl')))
+            self.assertEqual(stats['get']['rows'], 3)
+            self.assertEqual(sum(stats['check_df']['histogram']), stats['check_df']['calls'])
+
+            path = os.path.join(folder, 'stats.json')
+            caching.Cache.stats.dump(path)
+            with open(path) as f:
+                self.assertIn('elec_temp', json.load(f)['variables'])
+        finally:
+            caching.Cache.stats = None
+            shutil.rmtree(folder)
+
+    def test_window_days(self):
+        """The chunk window of cache_results is sized to the memory budget"""
+        day = 24 * 60 * caching.BYTES_PER_MINUTE
+        self.assertEqual(caching._window_days(None), caching.DEFAULT_WINDOW)
+        self.assertEqual(caching._window_days(10 * day), 10)
+        self.assertEqual(caching._window_days(10 * day, workers=4), 2)
+        self.assertEqual(caching._window_days(day / 2), 1)
+
+    def test_codec(self):
+        """Compressed data is read back by any cache, whatever its codec"""
+        folder = tempfile.mkdtemp()
+        try:
+            self.assertRaises(ValueError, caching.Cache, 'elec_temp', folder=folder, codec='foo')
+            ch = caching.Cache('elec_temp', folder=folder, codec='zlib')
+            index = pd.date_range(start='20160101', freq='D', periods=3, tz='Europe/Brussels')
+            ch._write(pd.DataFrame(index=index, data=dict(testsensor1=[0., 1., 2.])))
+            with open(os.path.join(folder, 'elec_temp_testsensor1.pkl'), 'rb') as f:
+                self.assertTrue(f.read().startswith(b'opengrid-codec:zlib'))
+
+            df = caching.Cache('elec_temp', folder=folder).get([Sensor(key='testsensor1')])
+            self.assertListEqual(df['testsensor1'].tolist(), [0., 1., 2.])
+        finally:
+            shutil.rmtree(folder)
+
+    def test_concurrent_update(self):
+        """Processes updating the same sensor do not lose each other's days"""
+        import multiprocessing
+        folder = tempfile.mkdtemp()
+        try:
+            processes = [multiprocessing.Process(target=update_days, args=(folder, first_day))
+                         for first_day in ['20160101', '20160103']]
+            for p in processes:
+                p.start()
+            for p in processes:
+                p.join()
+
+            ch = caching.Cache('elec_temp', folder=folder)
+            df = ch.get([Sensor(key='testsensor1')])
+            self.assertListEqual(df['testsensor1'].tolist(), list(range(1, 13)))
+            self.assertEqual(ch.coverage()['rows'].tolist(), [12])
+            # no temporary files are left behind
+            self.assertFalse([f for f in os.listdir(folder) if f.endswith('.tmp')])
+        finally:
+            shutil.rmtree(folder)
+
+    def test_cache_results_worker_dies(self):
+        """A worker that dies fails its sensor only, the others are cached"""
+        import tmpo
+        from opengrid.library.houseprint import houseprint
+
+        folder = tempfile.mkdtemp()
+        try:
+            hp = houseprint.Houseprint(empty_init=True)
+            hp.init_tmpo(tmpos=tmpo.Session(folder))
+            site = houseprint.Site(key=1)
+            hp.add_site(site)
+            device = houseprint.Device(key='d')
+            site.add_device(device)
+            for key in ['a', 'dying', 'b']:
+                device.add_sensor(DyingSensor(key=key, type='electricity'))
+
+            self.assertFalse(caching.cache_results(hp, hp.get_sensors(), 'elec_daily_max', analysis.DailyAgg,
+                                                   chunk=False, workers=1, folder=folder, agg='max'))
+            df = caching.Cache('elec_daily_max', folder=folder).get(hp.get_sensors())
+            self.assertListEqual(['a', 'b'], list(df.columns))
+            self.assertListEqual([23, 47], df['a'].tolist())
+            self.assertIsNotNone(hp.get_tmpos())
+        finally:
+            shutil.rmtree(folder)
+
+    def test_result_cache(self):
+        """Results are reused until the watermark of the sensor passes them"""
+        folder = tempfile.mkdtemp()
+        try:
+            cache = caching.ResultCache(folder=folder)
+            watermark = [100]
+            computed = []
+
+            def compute():
+                computed.append(1)
+                s = pd.Series([float(len(computed))], name='testsensor')
+                s.unit = 'W'
+                return s
+
+            key = ('testsensor', 0, 200, 'default', 'min', 'default', 'UTC')
+            self.assertEqual(cache.get(key, 200, lambda: watermark[0], compute).iloc[0], 1)
+            self.assertEqual(cache.get(key, 200, lambda: watermark[0], compute).unit, 'W')
+            self.assertEqual(len(computed), 1)
+
+            # new data within the query
+            watermark[0] = 150
+            self.assertEqual(cache.get(key, 200, lambda: watermark[0], compute).iloc[0], 2)
+
+            # a query that was complete is not checked again
+            key = ('testsensor', 0, 120, 'default', 'min', 'default', 'UTC')
+            cache.get(key, 120, lambda: watermark[0], compute)
+            watermark[0] = 300
+            self.assertEqual(cache.get(key, 120, lambda: watermark[0], compute).iloc[0], 3)
+
+            # the results survive in the folder
+            other = caching.ResultCache(folder=folder)
+            self.assertEqual(other.get(key, 120, lambda: watermark[0], compute).iloc[0], 3)
+            self.assertEqual((cache.hits, cache.misses, other.hits), (2, 3, 1))
+            other.clear()
+            self.assertEqual(os.listdir(folder), [])
+        finally:
+            shutil.rmtree(folder)
+
+    def test_dtype(self):
+        """A cache with a dtype stores and returns its values in that type"""
+        folder = tempfile.mkdtemp()
+        try:
+            testsensor = Sensor(key='testsensor')
+            index = pd.date_range(start='20160101', freq='D', periods=3, tz='Europe/Brussels')
+            df = pd.DataFrame(index=index, data=[0.5, 1.5, 2.5], columns=['testsensor'])
+            for storage in ['pickle', 'mmap']:
+                ch = caching.Cache('elec_temp', folder=folder, storage=storage, dtype='float32')
+                ch._write(df)
+                self.assertEqual(caching.Cache('elec_temp', folder=folder, storage=storage).get(
+                    [testsensor])['testsensor'].dtype, np.float32)
+                ch.update(pd.DataFrame(index=index[-2:] + pd.Timedelta(days=2), data=[3.5, 4.5],
+                                       columns=['testsensor']))
+                res = ch.get([testsensor])['testsensor']
+                self.assertEqual(res.dtype, np.float32)
+                self.assertListEqual([0.5, 1.5, 2.5, 3.5, 4.5], res.tolist())
+        finally:
+            shutil.rmtree(folder)
+
+    def test_lock_is_reentrant(self):
+        lock = caching.FileLock.get(os.path.join(tempfile.gettempdir(), 'opengrid_test.lock'))
+        self.assertIs(lock, caching.FileLock.get(lock.path))
+        with lock:
+            with lock:
+                self.assertIsNotNone(lock._fd)
+            self.assertIsNotNone(lock._fd)
+        self.assertIsNone(lock._fd)
+
 
 if __name__ == '__main__':
     
@@ -105,6 +105,21 @@ class MiscTest(unittest.TestCase):
         cf = unit_conversion_factor('Wh/min', 'kW')
         np.testing.assert_array_almost_equal(cf, 60 / 1000.)
 
+    def test_conversion_factor(self):
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return 2.
+
+        self.assertEqual(conversion_factor('test', compute), 2.)
+        self.assertEqual(conversion_factor('test', compute), 2.)
+        self.assertEqual(len(calls), 1)
+        clear_conversion_factors()
+        self.assertEqual(conversion_factor('test', compute), 2.)
+        self.assertEqual(len(calls), 2)
+        clear_conversion_factors()
+
     def test_dayset(self):
         ds = dayset(start=pd.Timestamp('20160101'), end=pd.Timestamp('20160131'))
         comp = [dt.date(year=2016, month=1, day=day) for day in range(1, 32)]
@@ -52,20 +52,14 @@ hp.init_tmpo()
 # In[ ]:
 
 
-sensors = hp.get_sensors() # sensor objects
-t = []
-for s in sensors:
-    key = s.key
-    lt = s.last_timestamp()
-    if lt is None:
-        continue
-    nr_of_days = pd.Timestamp('now', tz='UTC') - lt
-    t.append((key,nr_of_days))
+# last timestamp of all sensors, in one pass over the tmpo database
+last_timestamps = hp.last_timestamps().dropna()
 
 
 # In[ ]:
 
-df = pd.DataFrame(t).rename(columns={0: "sensor_id", 1: "timedelta"}).set_index('sensor_id')
+df = pd.DataFrame({'timedelta': pd.Timestamp('now', tz='UTC') - last_timestamps})
+df.index.name = 'sensor_id'
 
 
 # In[ ]:
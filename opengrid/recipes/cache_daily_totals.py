@@ -30,7 +30,6 @@ hp.init_tmpo()
 for sensortype in ['gas', 'electricity', 'water']:
     cache = caching.Cache(variable=sensortype + '_daily_total')
     sensors = hp.get_sensors(sensortype=sensortype)
-    df_cached = cache.get(sensors=sensors)
 
     # for each sensor:
     # 1. get the last timestamp of the cached daily total
@@ -38,10 +37,8 @@ for sensortype in ['gas', 'electricity', 'water']:
     # 3. fill up the cache with the new data
     print('Caching daily totals for {}'.format(sensortype))
     for sensor in tqdm(sensors):
-        try:
-            last_ts = df_cached[sensor.key].dropna().index[-1]
-            last_ts = last_ts.tz_convert('Europe/Brussels')
-        except:
+        last_ts = cache.last_day(sensor)
+        if last_ts is None:
             last_ts = pd.Timestamp('1970-01-01', tz='Europe/Brussels')
 
         # Only get data until the end of the last day
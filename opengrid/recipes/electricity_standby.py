@@ -70,11 +70,10 @@ hp.init_tmpo()
 # Afterwards, this is quick
 starttime = dt.time(0, tzinfo=BXL)
 endtime = dt.time(5, tzinfo=BXL)
-caching.cache_results(hp=hp, sensors=sensors, resultname='elec_min_night_0-5', AnalysisClass=DailyAgg,  
-                      agg='min', starttime=starttime, endtime=endtime)
-
-caching.cache_results(hp=hp, sensors=sensors, resultname='elec_max_night_0-5', AnalysisClass=DailyAgg, 
-                      agg='max', starttime=starttime, endtime=endtime)
+# Both variables are computed from a single pass over the data
+caching.cache_results(hp=hp, sensors=sensors, resultname={
+    'elec_min_night_0-5': (DailyAgg, dict(agg='min', starttime=starttime, endtime=endtime)),
+    'elec_max_night_0-5': (DailyAgg, dict(agg='max', starttime=starttime, endtime=endtime))})
 
 
 # In[ ]: